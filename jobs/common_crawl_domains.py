@@ -9,9 +9,9 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 import gzip
-import json
 import sys
 from urlparse import urlparse
+from smr import aggregators
 try:
     import warc
 except ImportError:
@@ -20,7 +20,7 @@ except ImportError:
 
 # use only a small chunk of it for testing purposes
 INPUT_DATA = "s3://aws-publicdatasets/common-crawl/crawl-002/2010/09/25/45"
-global_result = {}
+global_result = aggregators.Counter()
 
 # These are required to run smr-ec2, 
 # they can be passed on the command line as:
@@ -29,21 +29,18 @@ global_result = {}
 PIP_REQUIREMENTS = ["warc==0.2.1"]
 
 def MAP_FUNC(file_name):
-    result = {}
+    result = aggregators.Counter()
 
     with gzip.open(file_name) as f:
         w = warc.ARCFile(fileobj=f)
         for record in w:
-            domain = urlparse(record.header.url).hostname
-            result[domain] = result.get(domain, 0) + 1
+            result.add(urlparse(record.header.url).hostname)
 
-    print(json.dumps(result))
+    print(aggregators.dumps(result))
 
 def REDUCE_FUNC(result):
-    j = json.loads(result)
-    for key, count in j.iteritems():
-        global_result[key] = global_result.get(key, 0) + count
+    global_result.merge(aggregators.loads(result))
 
 def OUTPUT_RESULTS_FUNC():
-    for key, count in sorted(global_result.iteritems(), key=lambda x: x[1], reverse=True):
+    for key, count in global_result.most_common():
         print("{},{}".format(key, count))
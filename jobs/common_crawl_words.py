@@ -11,6 +11,7 @@ from __future__ import (absolute_import, division,
 import gzip
 import re
 import sys
+from smr import aggregators, merge_sorted
 try:
     from bs4 import BeautifulSoup
 except ImportError:
@@ -24,7 +25,7 @@ except ImportError:
 
 # use only a small chunk of it for testing purposes
 INPUT_DATA = "s3://aws-publicdatasets/common-crawl/crawl-002/2010/09/25/45"
-global_result = {}
+global_result = aggregators.Counter()
 
 # These are required to run smr-ec2, 
 # they can be passed on the command line as:
@@ -50,10 +51,24 @@ def MAP_FUNC(file_name):
             for word in REGEX_SPACE.split(payload):
                 print(word) # pass word to reducer
 
-def REDUCE_FUNC(word):
-    word = word.rstrip() # remove trailing linebreak
-    global_result[word] = global_result.get(word, 0) + 1
+def COMBINE_FUNC(words):
+    result = aggregators.Counter()
+    result.update(words)
+    for word, count in result.result().iteritems():
+        yield "{}\t{}".format(word, count)
+
+def PARTITION_FUNC(line):
+    return line.split("\t", 1)[0] # send all counts of the same word to the same reducer
+
+def REDUCE_FUNC(line):
+    word, count = line.split("\t", 1)
+    global_result.add(word, int(count))
 
 def OUTPUT_RESULTS_FUNC():
-    for word, count in sorted(global_result.iteritems(), key=lambda x: x[1], reverse=True):
+    for word, count in global_result.most_common():
         print("{},{}".format(word, count))
+
+def MERGE_RESULTS_FUNC(partition_files):
+    # every partition is sorted by count in descending order
+    for line in merge_sorted(partition_files, key=lambda line: -int(line.rsplit(",", 1)[1])):
+        sys.stdout.write(line)
@@ -17,6 +17,7 @@ setup(
             'smr-ec2 = smr.ec2:main',
             'smr-map = smr.map:main',
             'smr-reduce = smr.reduce:main',
+            'smr-worker = smr.worker:main',
         ]
     },
 )
@@ -1,8 +1,10 @@
-__all__ = ["run", "run_ec2", "run_map", "run_reduce", "get_config", "get_default_config"]
+__all__ = ["run", "run_ec2", "run_map", "run_reduce", "get_config", "get_default_config", "merge_sorted", "emit", "SpillingDict"]
 
 from .main import run
 from .ec2 import run as run_ec2
-from .map import run as run_map
+from .map import run as run_map, emit
 from .reduce import run as run_reduce
 from .config import get_config, get_default_config
+from .shared import merge_sorted
+from .spill import SpillingDict
 from .version import __version__
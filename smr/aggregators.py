@@ -0,0 +1,230 @@
+"""
+mergeable aggregators that can be used in MAP_FUNC, COMBINE_FUNC, REDUCE_FUNC and MERGE_RESULTS_FUNC
+
+every aggregator can be merged with another one of the same kind, e.g. the ones built by different mappers or
+reducers, and serialized with dumps() into a single line without linebreaks that loads() turns back into an
+aggregator, so it can be printed by MAP_FUNC, sent to REDUCE_FUNC or written out by OUTPUT_RESULTS_FUNC.
+they can also be returned by SNAPSHOT_FUNC as is
+
+TopK and HyperLogLog use bounded memory regardless of how many distinct keys they see
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import base64
+import hashlib
+import heapq
+import marshal
+import math
+import struct
+
+class Counter(object):
+    """ exact count of every key """
+    def __init__(self, counts=None):
+        self.counts = counts if counts is not None else {}
+
+    def add(self, key, count=1):
+        self.counts[key] = self.counts.get(key, 0) + count
+
+    def update(self, keys):
+        """ counts every key in keys once """
+        counts = self.counts
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, count in other.counts.iteritems():
+            self.add(key, count)
+
+    def result(self):
+        return self.counts
+
+    def most_common(self, n=None):
+        """ returns list of (key, count) tuples of n most common keys, or of all of them, by count in descending order """
+        if n is None:
+            return sorted(self.counts.iteritems(), key=lambda x: x[1], reverse=True)
+        return heapq.nlargest(n, self.counts.iteritems(), key=lambda x: x[1])
+
+    def get_state(self):
+        return self.counts
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state)
+
+class Sum(object):
+    def __init__(self, value=0):
+        self.value = value
+
+    def add(self, value):
+        self.value += value
+
+    def merge(self, other):
+        self.value += other.value
+
+    def result(self):
+        return self.value
+
+    def get_state(self):
+        return self.value
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state)
+
+class Min(object):
+    """ smallest value added, None if nothing was added """
+    def __init__(self, value=None):
+        self.value = value
+
+    def add(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+    def get_state(self):
+        return self.value
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state)
+
+class Max(Min):
+    """ largest value added, None if nothing was added """
+    def add(self, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+class TopK(object):
+    """
+    k keys with the largest counts, keeping counts of at most capacity keys (10 * k by default)
+    once there are more keys than that, counts are decreased by the count of the (capacity + 1)th largest one and
+    the ones that drop to 0 are forgotten (misra-gries summary). every count is then underestimated by at most
+    error, which is at most the total of all counts / (capacity + 1), so keys with counts larger than that are
+    never missed. counts are exact as long as there are no more than capacity distinct keys
+    """
+    def __init__(self, k, capacity=None, counts=None, error=0):
+        self.k = k
+        self.capacity = max(capacity or 10 * k, k)
+        self.counts = counts if counts is not None else {}
+        self.error = error
+
+    def add(self, key, count=1):
+        counts = self.counts
+        counts[key] = counts.get(key, 0) + count
+        # pruning is amortized over capacity additions of new keys
+        if len(counts) > 2 * self.capacity:
+            self.prune()
+
+    def update(self, keys):
+        """ counts every key in keys once """
+        for key in keys:
+            self.add(key)
+
+    def merge(self, other):
+        for key, count in other.counts.iteritems():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.error += other.error
+        self.prune()
+
+    def prune(self):
+        """ keeps counts of at most capacity keys """
+        if len(self.counts) <= self.capacity:
+            return
+        threshold = heapq.nlargest(self.capacity + 1, self.counts.itervalues())[-1]
+        self.counts = dict((key, count - threshold) for key, count in self.counts.iteritems() if count > threshold)
+        self.error += threshold
+
+    def result(self):
+        """ returns list of (key, count) tuples of top k keys by count in descending order """
+        self.prune()
+        return heapq.nlargest(self.k, self.counts.iteritems(), key=lambda x: x[1])
+
+    def get_state(self):
+        self.prune()
+        return self.k, self.capacity, self.counts, self.error
+
+    @classmethod
+    def from_state(cls, state):
+        k, capacity, counts, error = state
+        return cls(k, capacity, counts, error)
+
+class HyperLogLog(object):
+    """
+    approximate number of distinct values, using 2 ** precision bytes of memory (16KB by default)
+    standard error of the estimate is about 1.04 / sqrt(2 ** precision), 0.8% by default
+    """
+    def __init__(self, precision=14, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision has to be between 4 and 16")
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        (hashed,) = struct.unpack(b"<Q", hashlib.md5(value).digest()[:8])
+        index = hashed >> (64 - self.precision)
+        # position of the leftmost 1 bit in the rest of the hash
+        rank = 64 - self.precision - (hashed & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("can't merge HyperLogLog with precision {} into {}".format(other.precision, self.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def result(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(b"\x00")
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros) # linear counting is more accurate for small cardinalities
+        return int(round(estimate))
+
+    def get_state(self):
+        return self.precision, bytes(self.registers)
+
+    @classmethod
+    def from_state(cls, state):
+        precision, registers = state
+        return cls(precision, registers)
+
+AGGREGATORS = {
+    "counter": Counter,
+    "sum": Sum,
+    "min": Min,
+    "max": Max,
+    "topk": TopK,
+    "hll": HyperLogLog
+}
+AGGREGATOR_NAMES = dict((cls, name) for name, cls in AGGREGATORS.iteritems())
+
+def dumps(aggregator):
+    """ returns aggregator serialized into a single line without linebreaks """
+    return base64.b64encode(marshal.dumps((AGGREGATOR_NAMES[type(aggregator)], aggregator.get_state())))
+
+def loads(data):
+    """ returns aggregator serialized by dumps """
+    name, state = marshal.loads(base64.b64decode(data))
+    return AGGREGATORS[name].from_state(state)
+
+def merge(aggregators):
+    """ returns the first of aggregators with all of the other ones merged into it, None if there are none """
+    result = None
+    for aggregator in aggregators:
+        if result is None:
+            result = aggregator
+        else:
+            result.merge(aggregator)
+    return result
@@ -0,0 +1,170 @@
+"""
+on-disk cache of map output, used with --map-cache
+
+records that MAP_FUNC (through COMBINE_FUNC if it's defined) output for each file or split are kept in a file named
+after a hash of their source code, the uri and its etag or modification time that smr sends along with it, so that
+processing the same files with the same MAP_FUNC again replays the output instead of downloading and processing them.
+least recently used entries are evicted once the cache takes up more than config.map_cache_size bytes,
+until it takes up CACHE_EVICT_RATIO of that. the total size of the entries is kept in a .size file next to them,
+so that the cache is only listed when it has to be evicted
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import fcntl
+import hashlib
+import inspect
+import marshal
+import os
+import tempfile
+
+from .transport import encode_frame, read_records
+
+CACHE_FRAME_SIZE = 1024 * 1024 # records are written to cache entries in frames of about this many bytes
+CACHE_EVICT_RATIO = 0.9 # eviction leaves entries that take up this fraction of config.map_cache_size
+
+def get_code_hash(config):
+    """ returns hash of the code that map output depends on """
+    code_hash = hashlib.sha1()
+    for func in (config.MAP_FUNC, config.COMBINE_FUNC):
+        if func is None:
+            continue
+        try:
+            code_hash.update(inspect.getsource(func).encode("utf-8"))
+        except (IOError, TypeError):
+            code_hash.update(marshal.dumps(func.__code__)) # source isn't available
+    if config.COMBINE_FUNC:
+        code_hash.update(str(config.combine_window).encode("utf-8"))
+    return code_hash.hexdigest()
+
+class CacheEntry(object):
+    """ cache entry of a file or split, output is an open file with its cached records or None if it's not cached """
+    def __init__(self, path, output):
+        self.path = path
+        self.output = output
+
+    def read_records(self):
+        try:
+            for record in read_records(self.output):
+                yield record
+        finally:
+            self.output.close()
+
+class CacheEntryWriter(object):
+    """ writes records into a temp file that replaces the cache entry once commit() is called """
+    def __init__(self, cache, entry):
+        self.cache = cache
+        self.entry = entry
+        # temp files start with a dot, so that they're never mistaken for entries
+        self.temp_file = tempfile.NamedTemporaryFile(dir=cache.path, prefix=".", delete=False)
+        self.records = []
+        self.records_size = 0
+
+    def emit(self, record):
+        self.records.append(record)
+        self.records_size += len(record)
+        if self.records_size >= CACHE_FRAME_SIZE:
+            self.write_frame()
+
+    def write_frame(self):
+        if len(self.records) > 0:
+            self.temp_file.write(encode_frame(self.records))
+            self.records = []
+            self.records_size = 0
+
+    def commit(self):
+        self.write_frame()
+        self.temp_file.close()
+        self.cache.add(self.temp_file.name, self.entry.path)
+
+    def discard(self):
+        self.temp_file.close()
+        try:
+            os.unlink(self.temp_file.name)
+        except OSError:
+            pass
+
+class MapCache(object):
+    """ cache entries shared by every smr-map worker on the host, all of them are files in config.map_cache """
+    def __init__(self, config):
+        self.config = config
+        self.path = config.map_cache
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass # another worker created it in the meantime
+        self.code_hash = get_code_hash(config)
+
+    def get(self, uri, file_version):
+        """ returns CacheEntry of uri, which is a file or a split, with file_version being its etag or modification time """
+        key = hashlib.sha1(self.code_hash.encode("utf-8"))
+        key.update("{}\n{}".format(uri, file_version).encode("utf-8"))
+        path = os.path.join(self.path, key.hexdigest())
+        try:
+            output = open(path, "rb")
+        except IOError:
+            return CacheEntry(path, None)
+        try:
+            os.utime(path, None) # entries are evicted in order of their modification time
+        except OSError:
+            pass
+        return CacheEntry(path, output)
+
+    def writer(self, entry):
+        return CacheEntryWriter(self, entry)
+
+    def add(self, temp_path, path):
+        """ moves temp_path into place as the entry at path, evicts entries if the cache gets too large """
+        size = os.path.getsize(temp_path)
+        with open(os.path.join(self.path, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache_size = self.read_size()
+            if os.path.exists(path):
+                size -= os.path.getsize(path) # another worker cached the same file in the meantime
+            os.rename(temp_path, path)
+            cache_size += size
+            if cache_size > self.config.map_cache_size:
+                cache_size = self.evict(int(self.config.map_cache_size * CACHE_EVICT_RATIO))
+            self.write_size(cache_size)
+
+    def list_entries(self):
+        """ returns list of (modification time, size, path) tuples of every entry """
+        entries = []
+        for file_name in os.listdir(self.path):
+            if file_name.startswith("."):
+                continue
+            path = os.path.join(self.path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def read_size(self):
+        """ returns total size of the entries recorded in the .size file, or their actual size if there's none """
+        try:
+            with open(os.path.join(self.path, ".size")) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return sum(size for _, size, _ in self.list_entries())
+
+    def write_size(self, cache_size):
+        with open(os.path.join(self.path, ".size"), "w") as f:
+            f.write(str(cache_size))
+
+    def evict(self, max_size):
+        """
+        removes least recently used entries until the cache fits into max_size bytes, returns its size after that
+        the caller has to hold the lock of the cache
+        """
+        entries = self.list_entries()
+        cache_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if cache_size <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            cache_size -= size
+        return cache_size
@@ -16,6 +16,15 @@ LOG_LEVELS = {
     "debug": logging.DEBUG
 }
 
+INSTANCE_METADATA = {}
+
+def get_default_worker_socket():
+    """ returns path of smr-worker's socket in a directory that only the current user can access """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "smr-worker.sock")
+    return os.path.join(os.path.expanduser("~"), ".smr", "worker.sock")
+
 class DefaultConfig(object):
     def __init__(self):
         self.paramiko_log_level = "warning"
@@ -43,6 +52,43 @@ class DefaultConfig(object):
         self.date_range = None
         self.start_date = None
         self.end_date = None
+        self.combine_window = 100000
+        self.split_size = 0
+        self.batch_size = 0
+        self.schedule = "listing"
+        self.listing_concurrency = 8
+        self.manifest = None
+        self.manifest_settle_days = 1
+        self.manifest_max_age = None
+        self.reducers = 1
+        self.transport = "lines"
+        self.frame_size = 65536
+        self.direct_reduce = False
+        self.prefetch = 0
+        self.dispatch_depth = 1
+        self.speculation_factor = 0
+        self.speculation_min_time = 60.0
+        self.journal = None
+        self.resume = False
+        self.checkpoint_interval = 300.0
+        self.incremental = None
+        self.reduce_memory_limit = None
+        self.compress_output = 0
+        self.local_reduce = False
+        self.local_reduce_interval = 60
+        self.local_input = None
+        self.spill_dir = None
+        self.engine = "exec"
+        self.worker_socket = get_default_worker_socket()
+        self.worker_env = []
+        self.map_cache = None
+        self.map_cache_size = 10 * 1024 * 1024 * 1024
+        self.attempt_output = False
+        self.prefetch_bytes = 1024 * 1024 * 1024
+        self.ranged_download_concurrency = 1
+        self.ranged_download_threshold = 64 * 1024 * 1024
+        self.ranged_download_part_size = 16 * 1024 * 1024
+        self.direct_output = None
 
 def get_default_config():
     return DefaultConfig()
@@ -73,10 +119,32 @@ def get_config_module(config_name):
         setattr(config, "MAP_FUNC", None)
     if not hasattr(config, "REDUCE_FUNC"):
         setattr(config, "REDUCE_FUNC", None)
+    if not hasattr(config, "STREAM_INPUT"):
+        setattr(config, "STREAM_INPUT", False)
+    if not hasattr(config, "COMBINE_FUNC"):
+        setattr(config, "COMBINE_FUNC", None)
+    if not hasattr(config, "PARTITION_FUNC"):
+        setattr(config, "PARTITION_FUNC", None)
+    if not hasattr(config, "GROUP_BY_KEY"):
+        setattr(config, "GROUP_BY_KEY", False)
+    if not hasattr(config, "REDUCE_BATCH_FUNC"):
+        setattr(config, "REDUCE_BATCH_FUNC", None)
+    if not hasattr(config, "RESET_FUNC"):
+        setattr(config, "RESET_FUNC", None)
+    if not hasattr(config, "SNAPSHOT_FUNC"):
+        setattr(config, "SNAPSHOT_FUNC", None)
+    if not hasattr(config, "RESTORE_FUNC"):
+        setattr(config, "RESTORE_FUNC", None)
     if not hasattr(config, "OUTPUT_RESULTS_FUNC"):
         def default_output_results_func():
             print("done")
         setattr(config, "OUTPUT_RESULTS_FUNC", default_output_results_func)
+    if not hasattr(config, "MERGE_RESULTS_FUNC"):
+        def default_merge_results_func(partition_files):
+            for partition_file in partition_files:
+                for line in partition_file:
+                    sys.stdout.write(line)
+        setattr(config, "MERGE_RESULTS_FUNC", default_merge_results_func)
 
     return config
 
@@ -110,6 +178,43 @@ def get_config(args=None):
     parser.add_argument("--start-date", type=mkdate, help="start date (YYYY-mm-dd) for this job, only used if using {year}/{month}/{day} macros in INPUT_DATA")
     parser.add_argument("--end-date", type=mkdate, help="end date (YYYY-mm-dd) for this job, only used if using {year}/{month}/{day} macros in INPUT_DATA", default=datetime.datetime.utcnow().date())
     parser.add_argument("--date-range", type=int, help="number of days back to process, overrides start date if used")
+    parser.add_argument("--split-size", type=int, help="process uncompressed files larger than this many bytes in splits of this size, 0 to process every file as a whole", default=default_config.split_size)
+    parser.add_argument("--batch-size", type=int, help="process files smaller than this many bytes in batches of up to this size, 0 to process every file separately", default=default_config.batch_size)
+    parser.add_argument("--listing-concurrency", type=int, help="number of INPUT_DATA entries and days of the date range listed at the same time", default=default_config.listing_concurrency)
+    parser.add_argument("--manifest", help="JSON file with listings of INPUT_DATA that are reused instead of listing it again, it's created or updated after listing", default=default_config.manifest)
+    parser.add_argument("--manifest-settle-days", type=int, help="listings of days that ended more than this many days before they were listed are reused from --manifest, more recent days are listed again", default=default_config.manifest_settle_days)
+    parser.add_argument("--manifest-max-age", type=float, help="listings of INPUT_DATA entries without date macros are reused from --manifest for this many days after they were listed, by default they're listed again every time", default=default_config.manifest_max_age)
+    parser.add_argument("--schedule", help="order to process files in: as they are listed, starting while the rest are still being listed, or after listing all of them: largest first, or alternating between the largest and smallest ones, to avoid a long tail of large files at the end of the job", choices=("listing", "largest-first", "interleaved"), default=default_config.schedule)
+    parser.add_argument("--reducers", type=int, help="number of smr-reduce processes to use, map output is partitioned between them by PARTITION_FUNC", default=default_config.reducers)
+    parser.add_argument("--transport", help="how map output is sent to smr-reduce: one record per line, or length-prefixed frames of many records that can contain linebreaks", choices=("lines", "framed"), default=default_config.transport)
+    parser.add_argument("--frame-size", type=int, help="approximate size in bytes of frames sent by smr-map when using framed transport, and of writes to smr-reduce with --direct-reduce", default=default_config.frame_size)
+    parser.add_argument("--direct-reduce", help="smr-map workers write their output straight into pipes that smr-reduce reads instead of relaying it through smr (smr only)", action="store_true", default=default_config.direct_reduce)
+    parser.add_argument("--dispatch-depth", type=int, help="number of files each smr-map worker has queued up at any time, so it doesn't wait for smr between files", default=default_config.dispatch_depth)
+    parser.add_argument("--speculation-factor", type=float, help="once there are no more files to hand out, process files again on idle workers if they take this many times longer than expected from the median time per byte, keeping output of whichever attempt finishes first, 0 to disable (not supported with --direct-reduce)", default=default_config.speculation_factor)
+    parser.add_argument("--speculation-min-time", type=float, help="minimum number of seconds a file has to be processed for before it's processed again with --speculation-factor", default=default_config.speculation_min_time)
+    parser.add_argument("--journal", help="file to record processed files and snapshots of reducers' state taken by SNAPSHOT_FUNC in, so that the job can be resumed if it's aborted (not supported with --direct-reduce)", default=default_config.journal)
+    parser.add_argument("--resume", help="resume the job recorded in --journal: restore reducers' state with RESTORE_FUNC and only process files that weren't processed yet", action="store_true", default=default_config.resume)
+    parser.add_argument("--checkpoint-interval", type=float, help="how often to snapshot reducers' state and record it in --journal in seconds", default=default_config.checkpoint_interval)
+    parser.add_argument("--incremental", help="file to keep processed files and snapshots of reducers' state taken by SNAPSHOT_FUNC in between runs of the job, so that the next run only processes files that were added since then (not supported with --direct-reduce)", default=default_config.incremental)
+    parser.add_argument("--map-cache", help="directory on smr-map workers' hosts to cache output of MAP_FUNC for each file in, so that processing the same file with the same MAP_FUNC again replays its output instead", default=default_config.map_cache)
+    parser.add_argument("--map-cache-size", type=int, help="maximum size of --map-cache in bytes, least recently used files are evicted from it", default=default_config.map_cache_size)
+    parser.add_argument("--compress-output", type=int, help="zlib compression level (1-9) of smr-map output that smr-ec2 receives over ssh, 0 to receive it uncompressed", choices=range(10), default=default_config.compress_output)
+    parser.add_argument("--local-reduce", help="run smr-reduce on every instance of smr-ec2 that reduces output of its mappers and sends reducer's state taken by SNAPSHOT_FUNC to smr-ec2, which merges it with RESTORE_FUNC", action="store_true", default=default_config.local_reduce)
+    parser.add_argument("--local-reduce-interval", type=float, help="how often in seconds smr-reduce on instances sends its state to smr-ec2 and resets it with RESET_FUNC, with --local-reduce", default=default_config.local_reduce_interval)
+    parser.add_argument("--local-input", help="FIFO that mappers on the same instance write into, set by smr-ec2 for smr-reduce with --local-reduce", default=default_config.local_input)
+    parser.add_argument("--reduce-memory-limit", type=int, help="memory limit in bytes of SpillingDict state, and of sorting input of GROUP_BY_KEY jobs (512MB by default), of every smr-reduce process, once it's exceeded data is spilled to sorted run files in --spill-dir and merged when results are output", default=default_config.reduce_memory_limit)
+    parser.add_argument("--spill-dir", help="directory for run files spilled by smr-reduce processes, system temporary directory by default", default=default_config.spill_dir)
+    parser.add_argument("--engine", help="how smr starts smr-map and smr-reduce workers: exec runs a new process for each of them, fork forks them from a process that has the job's config loaded already, daemon forks them from smr-worker daemon that's running on this host", choices=["exec", "fork", "daemon"], default=default_config.engine)
+    parser.add_argument("--worker-socket", help="unix socket that smr-worker daemon listens on, used with --engine daemon", default=default_config.worker_socket)
+    parser.add_argument("--worker-env", help="names of environment variables that workers forked by smr-worker get from smr, used with --engine daemon", nargs="*", default=default_config.worker_env)
+    parser.add_argument("--attempt-output", help="send output of each file to smr in one piece once the file is processed, set by smr for smr-map when needed", action="store_true", default=default_config.attempt_output)
+    parser.add_argument("--prefetch", type=int, help="number of files each smr-map worker downloads in the background while processing the current file", default=default_config.prefetch)
+    parser.add_argument("--prefetch-bytes", type=int, help="maximum size in bytes of files each smr-map worker keeps downloaded ahead", default=default_config.prefetch_bytes)
+    parser.add_argument("--ranged-download-concurrency", type=int, help="number of byte ranges of a large S3 file downloaded at the same time, 1 to download it in a single request", default=default_config.ranged_download_concurrency)
+    parser.add_argument("--ranged-download-threshold", type=int, help="minimum size in bytes of S3 files that are downloaded in byte ranges", default=default_config.ranged_download_threshold)
+    parser.add_argument("--ranged-download-part-size", type=int, help="size in bytes of each byte range of S3 files downloaded in ranges", default=default_config.ranged_download_part_size)
+    parser.add_argument("--direct-output", help="FIFO that smr-map writes its output to, set by smr when using --direct-reduce", action="append", default=default_config.direct_output)
+    parser.add_argument("--combine-window", type=int, help="number of lines printed by MAP_FUNC to pass to COMBINE_FUNC at once, 0 to combine output of the whole file", default=default_config.combine_window)
 
     parser.add_argument("-v", "--version", action="version", version="SMR {}".format(__version__))
 
@@ -117,11 +222,18 @@ def get_config(args=None):
 
     return result
 
+def get_instance_iam_profile():
+    """ returns IAM profile of the current EC2 instance or None, it's looked up only once so forked workers reuse it """
+    if "iam_profile" not in INSTANCE_METADATA:
+        metadata = boto.utils.get_instance_metadata(timeout=1.0, num_retries=1, data='meta-data/iam/security-credentials/')
+        INSTANCE_METADATA["iam_profile"] = metadata.keys()[0] if len(metadata) > 0 else None
+    return INSTANCE_METADATA["iam_profile"]
+
 def configure_job(args):
     config = get_config_module(args.config)
 
     # add extra options to args that cannot be specified in cli
-    for arg in ("MAP_FUNC", "REDUCE_FUNC", "OUTPUT_RESULTS_FUNC", "INPUT_DATA"):
+    for arg in ("MAP_FUNC", "STREAM_INPUT", "COMBINE_FUNC", "PARTITION_FUNC", "REDUCE_FUNC", "REDUCE_BATCH_FUNC", "GROUP_BY_KEY", "SNAPSHOT_FUNC", "RESTORE_FUNC", "RESET_FUNC", "OUTPUT_RESULTS_FUNC", "MERGE_RESULTS_FUNC", "INPUT_DATA"):
         setattr(args, arg, getattr(config, arg))
 
     pip_requirements = getattr(config, "PIP_REQUIREMENTS", None)
@@ -131,9 +243,7 @@ def configure_job(args):
 
     # if we don't have aws credentials and no iam profile in config, attempt to use iam profile of current instance
     if not args.aws_iam_profile and (not args.aws_access_key or not args.aws_secret_key):
-        metadata = boto.utils.get_instance_metadata(timeout=1.0, num_retries=1, data='meta-data/iam/security-credentials/')
-        if len(metadata) > 0:
-            args.aws_iam_profile = metadata.keys()[0]
+        args.aws_iam_profile = get_instance_iam_profile()
 
     paramiko_level_str = args.paramiko_log_level.lower()
     paramiko_level = LOG_LEVELS.get(paramiko_level_str, logging.WARNING)
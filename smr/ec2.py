@@ -10,65 +10,71 @@ import paramiko
 import psutil
 from Queue import Queue
 import socket
-import subprocess
 import sys
 import threading
 import time
 
 from .version import __version__
 from .config import get_config, configure_job
-from .shared import reduce_thread, progress_thread, write_file_to_descriptor, print_pid, \
-    get_param, add_message, add_str, ensure_dir_exists, get_args
+from .shared import progress_thread, dispatch_files, requeue_files, print_pid, get_param, add_message, add_str, process_status_line, \
+    ensure_dir_exists, get_args, queue_map_output, get_partial_results_location, start_reducers, wait_for_reducers, \
+    Speculator, InputQueue, queue_input_files, get_journal, journal_thread, skip_processed, get_incremental_state, \
+    get_processed_files, restore_reducers, get_completed_files
+from .forkserver import get_fork_server
+from .transport import DecompressedReader
 from .uri import get_uris
 
 RSA_BITS = 2048
+COMPRESSED_STREAMS = [] # DecompressedReader of every mapper's stdout with --compress-output
+LOCAL_REDUCE_FIFO = "/tmp/smr-local-reduce" # FIFO that mappers on every instance write into with --local-reduce
 
 def get_ssh_connection():
     ssh_connection = paramiko.SSHClient()
     ssh_connection.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     return ssh_connection
 
-def worker_stdout_read_thread(output_queue, chan):
-    stdout = chan.makefile("rb")
-    for line in iter(stdout.readline, ""):
-        output_queue.put(line)
+def worker_stdout_read_thread(config, output_queues, chan, speculator, journal):
+    if config.compress_output:
+        stdout = DecompressedReader(chan.recv)
+        COMPRESSED_STREAMS.append(stdout)
+    else:
+        stdout = chan.makefile("rb")
+    queue_map_output(config, output_queues, stdout, speculator, journal)
+
+def get_output_sizes():
+    """ returns numbers of bytes of map output received with --compress-output before and after decompressing it """
+    return sum(x.compressed_size for x in COMPRESSED_STREAMS), sum(x.size for x in COMPRESSED_STREAMS)
 
-def worker_stderr_read_thread(processed_files_queue, input_queue, chan, ssh, abort_event):
+def describe_output_sizes():
+    compressed_size, size = get_output_sizes()
+    return "map output: {} bytes received, {} bytes decompressed ({:.1f}x)".format(compressed_size, size, size / max(compressed_size, 1))
+
+def worker_stderr_read_thread(config, processed_files_queue, input_queue, chan, ssh, abort_event, speculator):
 
     stdin = chan.makefile("wb")
     stderr = chan.makefile_stderr("rb")
 
-    # write first file to mapper
-    if not abort_event.is_set() and not write_file_to_descriptor(input_queue, stdin):
+    # write first files to mapper
+    in_flight = []
+    stdin_open = not abort_event.is_set() and dispatch_files(config, input_queue, stdin, in_flight, speculator, chan)
+    if not stdin_open:
+        # stdin.close() is not enough with paramiko to actually close it, need to do this too:
         chan.shutdown_write()
-        abort_event.set()
-        sys.exit(1)
 
     for line in iter(stderr.readline, ""):
-        line = line.rstrip() # remove trailing linebreak
-        splt = line.split(",", 2)
-        if len(splt) != 3:
-            add_message("invalid message received from mapper: {}".format(line))
-        else:
-            file_status, file_size, file_name = splt
-            if file_status == "+":
-                processed_files_queue.put((file_name, int(file_size)))
-            elif file_status == "!":
-                add_message("error processing {}, requeuing...".format(file_name))
-                input_queue.put(file_name) # re-queue file
-            else:
-                add_message("invalid status received from mapper: {}".format(file_status))
+        process_status_line(line, processed_files_queue, input_queue, in_flight, speculator, chan)
 
         if abort_event.is_set():
             break
-        if not write_file_to_descriptor(input_queue, stdin):
-            # stdin.close() is not enough with paramiko to actually close it, need to do this too:
+        if stdin_open and not dispatch_files(config, input_queue, stdin, in_flight, speculator, chan):
+            # once there are no more files mapper finishes the ones it has and exits
             chan.shutdown_write()
-            break
+            stdin_open = False
 
-        if chan.exit_status_ready():
+        if stdin_open and chan.exit_status_ready():
             break
 
+    requeue_files(input_queue, in_flight, speculator, chan)
     if not abort_event.is_set():
         while not chan.exit_status_ready():
             time.sleep(1)
@@ -164,30 +170,89 @@ def run_command(ssh, instance, command):
         ssh.close()
         return False
 
-def start_worker(config, instance, abort_event, output_queue, processed_files_queue, input_queue, ssh_key):
-    ssh = get_ssh_connection()
+def get_remote_command(config, process, *extra_args):
+    """ returns command that runs smr-map or smr-reduce on an instance """
+    args = get_args(process, config, config.aws_ec2_remote_config_path)
+    if config.compress_output:
+        # process compresses its stdout once it's told to, smr-ec2 decompresses it in worker_stdout_read_thread
+        extra_args += ("--compress-output", str(config.compress_output))
+    args[1:1] = extra_args
+    return " ".join(args)
 
+def connect_to_instance(config, instance, abort_event, ssh_key):
+    ssh = get_ssh_connection()
     try:
         ssh.connect(instance.ip_address, username=config.aws_ec2_ssh_username, pkey=ssh_key)
     except:
         print("could not ssh to {} {}".format(instance.id, instance.ip_address))
         abort_event.set()
         sys.exit(1)
+    return ssh
+
+def start_worker(config, instance, abort_event, output_queues, processed_files_queue, input_queue, ssh_key, speculator, journal):
+    ssh = connect_to_instance(config, instance, abort_event, ssh_key)
 
     chan = ssh.get_transport().open_session()
-    chan.exec_command(" ".join(get_args("smr-map", config, config.aws_ec2_remote_config_path)))
+    if config.local_reduce:
+        chan.exec_command(get_remote_command(config, "smr-map", "--direct-output", LOCAL_REDUCE_FIFO))
+    else:
+        chan.exec_command(get_remote_command(config, "smr-map"))
 
-    stdout_thread = threading.Thread(target=worker_stdout_read_thread, args=(output_queue, chan))
+    stdout_thread = threading.Thread(target=worker_stdout_read_thread, args=(config, output_queues, chan, speculator, journal))
     stdout_thread.daemon = True
     stdout_thread.start()
 
-    stderr_thread = threading.Thread(target=worker_stderr_read_thread, args=(processed_files_queue, input_queue, chan, ssh, abort_event))
+    stderr_thread = threading.Thread(target=worker_stderr_read_thread, args=(config, processed_files_queue, input_queue, chan, ssh, abort_event, speculator))
     stderr_thread.daemon = True
     stderr_thread.start()
 
     return (chan, stderr_thread)
 
-def curses_thread(config, abort_event, instances, reduce_processes, window, start_time, bytes_total):
+def local_reducer_stderr_thread(instance, chan):
+    stderr = chan.makefile_stderr("rb")
+    for line in iter(stderr.readline, ""):
+        add_message("instance {} smr-reduce: {}".format(instance.id, line.rstrip()))
+
+def start_local_reducer(config, instance, abort_event, output_queues, ssh_key):
+    """
+    starts smr-reduce on instance with --local-reduce, mappers on the instance write their output into its FIFO
+    returns (chan, ssh, stdout_thread) tuple, smr-reduce sends its last partial aggregate and exits once chan is shut down
+    """
+    ssh = connect_to_instance(config, instance, abort_event, ssh_key)
+    if not run_command(ssh, instance, "rm -f {0} {0}.lock && mkfifo {0} && touch {0}.lock".format(LOCAL_REDUCE_FIFO)):
+        abort_event.set()
+        sys.exit(1)
+
+    chan = ssh.get_transport().open_session()
+    chan.exec_command(get_remote_command(config, "smr-reduce", "--local-input", LOCAL_REDUCE_FIFO, "--local-reduce-interval", str(config.local_reduce_interval)))
+
+    # partial aggregates are control records that are queued for the reducer the same way as map output
+    stdout_thread = threading.Thread(target=worker_stdout_read_thread, args=(config, output_queues, chan, None, None))
+    stdout_thread.daemon = True
+    stdout_thread.start()
+
+    stderr_thread = threading.Thread(target=local_reducer_stderr_thread, args=(instance, chan))
+    stderr_thread.daemon = True
+    stderr_thread.start()
+
+    return (chan, ssh, stdout_thread)
+
+def check_local_reduce(config):
+    """ exits if the job can't be run with --local-reduce """
+    if not config.local_reduce:
+        return
+    if not config.SNAPSHOT_FUNC or not config.RESTORE_FUNC:
+        sys.stderr.write("you need to provide SNAPSHOT_FUNC and RESTORE_FUNC in config to use --local-reduce\n")
+        sys.exit(1)
+    if config.GROUP_BY_KEY:
+        sys.stderr.write("--local-reduce is not supported with GROUP_BY_KEY\n")
+        sys.exit(1)
+    if config.reducers > 1:
+        # state of an instance has values of every key, it can't be partitioned
+        sys.stderr.write("--local-reduce is not supported with --reducers N\n")
+        sys.exit(1)
+
+def curses_thread(config, abort_event, instances, reduce_processes, window, start_time):
     reduce_pids = [psutil.Process(x.pid) for x in reduce_processes]
     sleep_time = config.screen_refresh_interval - (config.cpu_usage_interval * len(reduce_pids))
     while not abort_event.is_set() and sleep_time > 0 and not abort_event.wait(sleep_time):
@@ -206,8 +271,11 @@ def curses_thread(config, abort_event, instances, reduce_processes, window, star
         for p in reduce_pids:
             print_pid(p, window, i, "smr-reduce")
             i += 1
-        add_str(window, i + 1, "job progress: {0:%}".format(get_param("bytes_processed") / bytes_total))
+        add_str(window, i + 1, "job progress: {0:%}".format(get_param("bytes_processed") / max(get_param("bytes_total"), 1)))
         add_str(window, i + 2, "last file processed: {}".format(get_param("last_file_processed")))
+        if config.compress_output:
+            i += 1
+            add_str(window, i + 2, describe_output_sizes())
         messages = get_param("messages")[-10:]
         if len(messages) > 0:
             add_str(window, i + 3, "last messages:")
@@ -218,29 +286,57 @@ def curses_thread(config, abort_event, instances, reduce_processes, window, star
         if not abort_event.is_set():
             window.refresh()
 
-def run_job_on_instances(config, instances, abort_event, output_queue, processed_files_queue, input_queue, ssh_key):
+def run_job_on_instances(config, instances, abort_event, output_queues, processed_files_queue, input_queue, ssh_key, speculator, journal):
+    local_reducers = []
+    if config.local_reduce:
+        for instance in instances:
+            local_reducers.append(start_local_reducer(config, instance, abort_event, output_queues, ssh_key))
+
     workers = []
     for instance in instances:
         for _ in xrange(config.workers):
-            workers.append(start_worker(config, instance, abort_event, output_queue, processed_files_queue, input_queue, ssh_key))
+            workers.append(start_worker(config, instance, abort_event, output_queues, processed_files_queue, input_queue, ssh_key, speculator, journal))
 
+    mappers_succeeded = True
     for chan, worker in workers:
         worker.join()
+        if speculator and chan in speculator.cancelled:
+            continue # closed because another attempt processed its file first
         exit_code = chan.recv_exit_status()
         if exit_code != 0:
             sys.stderr.write("map process exited with code {}\n".format(exit_code))
+            mappers_succeeded = False
 
-def run_helper(config, ssh_key, bytes_total, file_names, instances):
-    files_total = len(file_names)
-    input_queue = Queue(files_total)
-    for file_name in file_names:
-        input_queue.put(file_name)
-    output_queue = Queue()
-    processed_files_queue = Queue(files_total)
+    for chan, ssh, stdout_thread in local_reducers:
+        chan.shutdown_write() # all mappers exited
+        stdout_thread.join()
+        exit_code = chan.recv_exit_status()
+        ssh.close()
+        if exit_code != 0:
+            sys.stderr.write("local reduce process exited with code {}\n".format(exit_code))
+            print("partial results are in {}".format(get_partial_results_location(config)))
+            abort_event.set()
+            sys.exit(1)
+    return mappers_succeeded
+
+def run_helper(config, ssh_key, file_names, file_sizes, instances, journal, state, listed_files, processed, fork_server):
+    input_queue = InputQueue()
+    processed_files_queue = Queue()
 
     start_time = datetime.datetime.now()
 
     abort_event = threading.Event()
+    speculator = None
+    if config.speculation_factor > 0:
+        if config.local_reduce:
+            # output that mappers wrote into local reducers can't be taken back
+            print("speculative execution is not supported with --local-reduce, disabling it")
+            config.speculation_factor = 0
+        else:
+            speculator = Speculator(config, input_queue, file_sizes, abort_event, lambda chan: chan.close())
+    # mappers send output of each file in one piece, so that smr knows when all of it was queued
+    config.attempt_output = speculator is not None or journal is not None
+    queue_input_files(input_queue, [(file_name, file_sizes[file_name]) for file_name in file_names], file_sizes, speculator, listed_files)
     try:
         initialize_instances(config, instances, abort_event, ssh_key)
     except KeyboardInterrupt:
@@ -260,12 +356,13 @@ def run_helper(config, ssh_key, bytes_total, file_names, instances):
             config.output_filename = "results/{}.{}.out".format(os.path.basename(config.config), datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
         ensure_dir_exists(config.output_filename)
 
-        reduce_stdout = open(config.output_filename, "w")
-        reduce_process = subprocess.Popen(get_args("smr-reduce", config, config.config), stdin=subprocess.PIPE, stdout=reduce_stdout, stderr=subprocess.PIPE)
-
-        reduce_worker = threading.Thread(target=reduce_thread, args=(reduce_process, output_queue, abort_event))
-        #reduce_worker.daemon = True
-        reduce_worker.start()
+        reducers = start_reducers(config, abort_event, fork_server=fork_server)
+        output_queues = [output_queue for _, _, output_queue, _ in reducers]
+        restore_reducers(output_queues, journal, state)
+        if journal:
+            journal_worker = threading.Thread(target=journal_thread, args=(journal, output_queues, abort_event))
+            journal_worker.daemon = True
+            journal_worker.start()
 
         progress_worker = threading.Thread(target=progress_thread, args=(processed_files_queue, abort_event))
         #progress_worker.daemon = True
@@ -273,20 +370,27 @@ def run_helper(config, ssh_key, bytes_total, file_names, instances):
 
         if config.output_job_progress:
             window = curses.initscr()
-            curses_worker = threading.Thread(target=curses_thread, args=(config, abort_event, instances, [reduce_process], window, start_time, bytes_total))
+            curses_worker = threading.Thread(target=curses_thread, args=(config, abort_event, instances, [x[0] for x in reducers], window, start_time))
             #curses_worker.daemon = True
             curses_worker.start()
 
-        run_job_on_instances(config, instances, abort_event, output_queue, processed_files_queue, input_queue, ssh_key)
+        mappers_succeeded = run_job_on_instances(config, instances, abort_event, output_queues, processed_files_queue, input_queue, ssh_key, speculator, journal)
     except KeyboardInterrupt:
         abort_event.set()
         if config.output_job_progress:
             curses.endwin()
         print("user aborted. elapsed time: {}".format(str(datetime.datetime.now() - start_time)))
-        print("partial results are in {}".format(config.output_filename))
+        print("partial results are in {}".format(get_partial_results_location(config)))
+        if journal:
+            print("run it again with --resume to continue from the last checkpoint in {}".format(config.journal))
         sys.exit(1)
 
-    output_queue.join() # wait for reducer to process everything
+    for output_queue in output_queues:
+        output_queue.join() # wait for reducers to process everything
+    if state and not (mappers_succeeded and input_queue.empty()):
+        print("not every file was processed, state of the job in {} was not updated".format(config.incremental))
+    elif state and not state.save(output_queues, abort_event, get_completed_files(listed_files, processed)):
+        print("could not save state of the job in {}".format(config.incremental))
 
     abort_event.set()
     if config.output_job_progress:
@@ -294,28 +398,70 @@ def run_helper(config, ssh_key, bytes_total, file_names, instances):
         curses.endwin()
 
     # wait for reduce to finish before exiting
-    reduce_worker.join()
-    (_, stderr) = reduce_process.communicate()
-    if stderr:
-        sys.stderr.write(stderr)
-    if reduce_process.returncode != 0:
-        print("reduce process {} exited with code {}".format(reduce_process.pid, reduce_process.returncode))
-        print("partial results are in {}".format(config.output_filename))
+    if not wait_for_reducers(config, reducers):
+        print("partial results are in {}".format(get_partial_results_location(config)))
         sys.exit(1)
 
-    reduce_stdout.close()
     for message in get_param("messages"):
         print(message)
-    
+    if config.compress_output:
+        print(describe_output_sizes())
+
+    print("done. elapsed time: {}".format(str(datetime.datetime.now() - start_time)))
+    print("results are in {}".format(config.output_filename))
+
+def write_restored_results(config, journal, state, fork_server, listed_files, processed):
+    """
+    writes out results of the previous runs of an incremental job that has no new files to process,
+    with reducers on this host only, without starting any instances
+    """
+    start_time = datetime.datetime.now()
+    if not config.output_filename:
+        config.output_filename = "results/{}.{}.out".format(os.path.basename(config.config), datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
+    ensure_dir_exists(config.output_filename)
+
+    abort_event = threading.Event()
+    reducers = start_reducers(config, abort_event, fork_server=fork_server)
+    output_queues = [output_queue for _, _, output_queue, _ in reducers]
+    restore_reducers(output_queues, journal, state)
+    for output_queue in output_queues:
+        output_queue.join() # wait for reducers to restore their state
+    if not state.save(output_queues, abort_event, get_completed_files(listed_files, processed)):
+        print("could not save state of the job in {}".format(config.incremental))
+    abort_event.set()
+
+    if not wait_for_reducers(config, reducers):
+        print("partial results are in {}".format(get_partial_results_location(config)))
+        sys.exit(1)
+
+    if config.compress_output:
+        print(describe_output_sizes())
+
     print("done. elapsed time: {}".format(str(datetime.datetime.now() - start_time)))
     print("results are in {}".format(config.output_filename))
 
 def run(config):
     configure_job(config)
+    journal = get_journal(config)
+    state = get_incremental_state(config)
+    check_local_reduce(config)
+    # smr-map runs on EC2 instances, only reducers on this host are forked
+    fork_server = get_fork_server(config)
 
     print("getting list of the files to process...")
-    bytes_total, file_names = get_uris(config)
+    file_sizes = {}
+    listed_files = []
+    _, file_names = get_uris(config, file_sizes, listed_files)
+    processed = get_processed_files(listed_files, journal, state)
+    if processed:
+        units = list(skip_processed([(file_name, file_sizes[file_name]) for file_name in file_names], processed))
+        file_names = [file_name for file_name, _ in units]
+        file_sizes = dict(units)
     if len(file_names) <= 0:
+        if state and state.snapshots:
+            print("no new files since the last run")
+            write_restored_results(config, journal, state, fork_server, listed_files, processed)
+            return
         sys.stderr.write("no files to process\n")
         sys.exit(1)
 
@@ -338,7 +484,7 @@ echo "ssh-rsa {public_key} smr" > /home/{user}/.ssh/authorized_keys
         instance.add_tag('Name', 'smr-worker')
         instance.add_tag('job', os.path.basename(config.config))
     try:
-        run_helper(config, ssh_key, bytes_total, file_names, instances)
+        run_helper(config, ssh_key, file_names, file_sizes, instances, journal, state, listed_files, processed, fork_server)
     finally:
         instance_ids = [instance.id for instance in instances]
         print("terminating all instances: {}".format(",".join(instance_ids)))
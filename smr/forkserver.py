@@ -0,0 +1,328 @@
+"""
+fork server that starts smr-map and smr-reduce workers, used with --engine fork and --engine daemon
+
+a template process is forked from smr before it starts any threads, once the job's config is loaded and configured,
+or from smr-worker daemon for every job that connects to it, in which case it loads the job's config on demand.
+every worker is forked from the template instead of running a new smr-map or smr-reduce process, so it doesn't
+import modules, load the config or look up instance metadata again. workers talk to smr the same way as with
+--engine exec: pipes are FIFOs that the template opens before forking the worker, and smr opens on its side.
+the template reports every worker's pid once it's forked, and its exit code once it exits.
+a template of smr-worker runs in smr's working directory, but only gets the environment variables named in
+--worker-env from it, so that the rest of smr's environment isn't sent over the socket
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import atexit
+import errno
+import fcntl
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from .config import get_config, configure_job
+from .map import run as run_map
+from .reduce import run as run_reduce
+
+WORKERS = {
+    "smr-map": run_map,
+    "smr-reduce": run_reduce
+}
+REAP_INTERVAL = 0.1 # how often the template checks for workers that exited, in seconds
+FIFO_OPEN_INTERVAL = 0.01 # how often smr tries to open a worker's stdin until the template opened it, in seconds
+
+class ForkedProcess(object):
+    """ subprocess.Popen-like handle of a worker forked by ForkServer """
+    def __init__(self, pid):
+        self.pid = pid
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.exited = threading.Event()
+
+    def set_returncode(self, returncode):
+        self.returncode = returncode
+        self.exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        # waiting with a timeout, so that KeyboardInterrupt isn't blocked
+        while not self.exited.wait(1):
+            pass
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def communicate(self):
+        if self.stdin:
+            self.stdin.close()
+        stdout = self.stdout.read() if self.stdout else None
+        stderr = self.stderr.read() if self.stderr else None
+        self.wait()
+        return stdout, stderr
+
+class ForkServer(object):
+    """
+    forks the template process, has to be created before smr starts any threads,
+    or connects to smr-worker daemon listening on socket_path which forks a template for this job,
+    that template gets environment variables named in env_names from smr
+    """
+    def __init__(self, socket_path=None, env_names=()):
+        self.fifo_dir = tempfile.mkdtemp(prefix="smr")
+        self.env_names = env_names
+        self.socket = None
+        if socket_path:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(socket_path)
+            self.requests = self.socket.makefile("w", 0)
+            self.responses = self.socket.makefile("r")
+        else:
+            request_read, request_write = os.pipe()
+            response_read, response_write = os.pipe()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                os.close(request_write)
+                os.close(response_read)
+                serve(request_read, response_write)
+            os.close(request_read)
+            os.close(response_write)
+            self.requests = os.fdopen(request_write, "w", 0)
+            self.responses = os.fdopen(response_read, "r")
+        self.lock = threading.Lock()
+        self.started = threading.Condition(self.lock)
+        self.last_request_id = 0
+        self.processes = {} # pid -> ForkedProcess
+        self.requested = {} # request id -> ForkedProcess once it's started
+        self.closed = False # set once the template exited or smr-worker closed the connection
+        response_worker = threading.Thread(target=self.response_thread)
+        response_worker.daemon = True
+        response_worker.start()
+        atexit.register(self.close)
+
+    def response_thread(self):
+        for line in iter(self.responses.readline, ""):
+            response = line.split()
+            with self.lock:
+                if response[0] == "started":
+                    process = ForkedProcess(int(response[2]))
+                    self.processes[process.pid] = process
+                    self.requested[int(response[1])] = process
+                    self.started.notify_all()
+                elif response[0] == "exited":
+                    self.processes.pop(int(response[1])).set_returncode(int(response[2]))
+        with self.lock:
+            if not self.closed: # close() could have been called by atexit, while the interpreter is shutting down
+                self.closed = True
+                self.started.notify_all()
+
+    def open_fifo(self, path, flags):
+        """
+        opens a FIFO of a worker without blocking, raises IOError if the template exits before it opens the other end
+        reading ends can be opened right away, writing ends only once the template opened them for reading
+        """
+        while True:
+            try:
+                return os.open(path, flags | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+            if self.closed:
+                raise IOError("fork server exited")
+            time.sleep(FIFO_OPEN_INTERVAL)
+
+    def spawn(self, args, stdin=None, stdout=None, stderr=None):
+        """
+        forks a worker that runs what args would run as a new process, returns its ForkedProcess
+        each of stdin, stdout and stderr is either subprocess.PIPE, a path to open or None to inherit it from smr
+        """
+        with self.lock:
+            self.last_request_id += 1
+            request_id = self.last_request_id
+            streams = []
+            for name, stream in (("stdin", stdin), ("stdout", stdout), ("stderr", stderr)):
+                if stream == subprocess.PIPE:
+                    stream = os.path.join(self.fifo_dir, "{}.{}".format(request_id, name))
+                    os.mkfifo(stream)
+                    streams.append((stream, True))
+                else:
+                    streams.append((stream, False))
+            # template of smr-worker daemon runs in its own directory and environment
+            request = {"id": request_id, "args": args, "streams": streams, "cwd": os.getcwd(),
+                       "env": dict((name, os.environ[name]) for name in self.env_names if name in os.environ)}
+            self.requests.write("{}\n".format(json.dumps(request)))
+
+        # template opens stdin first and blocks until it's opened here, so reading ends have to be opened before it
+        fds = [None, None, None]
+        try:
+            for i in (1, 2, 0):
+                path, is_fifo = streams[i]
+                if is_fifo:
+                    fds[i] = self.open_fifo(path, os.O_WRONLY if i == 0 else os.O_RDONLY)
+            with self.lock:
+                while request_id not in self.requested:
+                    if self.closed:
+                        raise IOError("fork server exited")
+                    self.started.wait(1)
+                process = self.requested.pop(request_id)
+        except:
+            for fd in fds:
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            for path, is_fifo in streams:
+                if is_fifo:
+                    os.unlink(path)
+
+        # worker has the other ends of its FIFOs open now, so reading them doesn't end before it exits
+        pipes = []
+        for fd, mode in zip(fds, ("wb", "rb", "rb")):
+            if fd is None:
+                pipes.append(None)
+                continue
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            pipes.append(os.fdopen(fd, mode, 0 if mode == "wb" else -1))
+        process.stdin, process.stdout, process.stderr = pipes
+        return process
+
+    def close(self):
+        """ stops the template, workers that are still running are not affected """
+        with self.lock:
+            self.closed = True
+        self.requests.close()
+        if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.socket.close()
+        shutil.rmtree(self.fifo_dir, ignore_errors=True)
+
+def get_fork_server(config):
+    """ returns ForkServer that workers should be forked from according to config.engine, or None to exec them """
+    if config.engine == "fork":
+        return ForkServer()
+    if config.engine == "daemon":
+        try:
+            return ForkServer(config.worker_socket, config.worker_env)
+        except socket.error as e:
+            sys.stderr.write("could not connect to smr-worker on {}: {}\n".format(config.worker_socket, e))
+            sys.exit(1)
+    return None
+
+def open_streams(streams):
+    """ opens streams of a worker in the template, returns their fds or None for the ones that are inherited """
+    fds = []
+    for (path, _), flags in zip(streams, (os.O_RDONLY, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)):
+        fds.append(None if path is None else os.open(path, flags, 0o644))
+    return fds
+
+def serve(request_fd, response_fd, load_config=False):
+    """
+    runs the template until smr closes its requests pipe, never returns
+    with load_config the job's config is loaded and configured once the first worker is requested
+    """
+    code = 0
+    try:
+        # workers get SIGINT from the terminal on their own, the template keeps running until smr is done with it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        responses = os.fdopen(response_fd, "w", 0)
+        workers = set()
+        requests = b""
+        while True:
+            readable, _, _ = select.select([request_fd], [], [], REAP_INTERVAL)
+            while workers:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                workers.discard(pid)
+                returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                responses.write("exited {} {}\n".format(pid, returncode))
+            if not readable:
+                continue
+            data = os.read(request_fd, 65536)
+            if not data:
+                break # smr is done
+            requests += data
+            while b"\n" in requests:
+                line, requests = requests.split(b"\n", 1)
+                request = json.loads(line)
+                os.chdir(request["cwd"])
+                os.environ.update(request["env"])
+                if load_config:
+                    load_config = False
+                    preload_config(request["args"])
+                fds = open_streams(request["streams"])
+                pid = os.fork()
+                if pid == 0:
+                    responses.close()
+                    if request_fd != response_fd:
+                        os.close(request_fd)
+                    run_worker(request["args"], fds)
+                for fd in fds:
+                    if fd is not None:
+                        os.close(fd)
+                workers.add(pid)
+                responses.write("started {} {}\n".format(request["id"], pid))
+    except IOError as e:
+        if e.errno != errno.EPIPE: # smr exited without waiting for its workers
+            traceback.print_exc()
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    os._exit(code)
+
+def preload_config(args):
+    """ loads and configures the job's config in the template, workers fail on their own if it can't be loaded """
+    try:
+        configure_job(get_config(args[1:]))
+    except BaseException:
+        pass
+
+def run_worker(args, fds):
+    """ runs a worker forked from the template with fds as its stdin, stdout and stderr, never returns """
+    code = 1
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for target_fd, fd in enumerate(fds):
+            if fd is not None:
+                os.dup2(fd, target_fd)
+                os.close(fd)
+        # new file objects, so that they're buffered the same way as in a new process
+        sys.stdin = os.fdopen(0, "r")
+        sys.stdout = os.fdopen(1, "w")
+        sys.stderr = os.fdopen(2, "w", 0)
+        WORKERS[args[0]](get_config(args[1:]))
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except IOError:
+            pass
+        os._exit(code)
@@ -2,6 +2,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 import curses
 import datetime
+import itertools
 import os
 import psutil
 from Queue import Queue
@@ -11,53 +12,65 @@ import threading
 
 from .version import __version__
 from .config import get_config, configure_job
-from .shared import reduce_thread, progress_thread, write_file_to_descriptor, print_pid, \
-    get_param, add_message, add_str, ensure_dir_exists, get_args
-from .uri import get_uris
-
-def worker_stdout_read_thread(output_queue, map_process, abort_event):
-    check_map_process(map_process, abort_event)
-    for line in iter(map_process.stdout.readline, ""):
-        output_queue.put(line)
+from .shared import progress_thread, dispatch_files, requeue_files, print_pid, get_param, add_message, add_str, process_status_line, \
+    ensure_dir_exists, get_args, queue_map_output, get_partial_results_location, start_reducers, wait_for_reducers, \
+    create_direct_outputs, close_direct_outputs, remove_direct_outputs, Speculator, InputQueue, queue_input_files, \
+    get_journal, journal_thread, skip_processed, get_incremental_state, get_processed_files, restore_reducers, start_process, \
+    get_completed_files
+from .forkserver import get_fork_server
+from .uri import get_uris, list_units, describe_units
+
+def worker_stdout_read_thread(config, output_queues, map_process, abort_event, speculator, journal):
+    check_map_process(map_process, abort_event, speculator)
+    queue_map_output(config, output_queues, map_process.stdout, speculator, journal)
     map_process.wait()
 
-def check_map_process(map_process, abort_event):
+def check_map_process(map_process, abort_event, speculator):
     map_process.poll()
-    if map_process.returncode is not None:
+    if map_process.returncode is not None and not is_cancelled(map_process, speculator):
         abort_event.set()
 
-def worker_stderr_read_thread(processed_files_queue, input_queue, map_process, abort_event):
-    check_map_process(map_process, abort_event)
+def direct_reducers_thread(reducers, abort_event, mappers_done_event):
+    """ aborts the job if a reducer exits while mappers are still writing into its FIFO, with --direct-reduce """
+    while not abort_event.is_set() and not mappers_done_event.wait(1):
+        for reduce_process, _, _, _ in reducers:
+            if reduce_process.poll() is not None:
+                abort_event.set() # wait_for_reducers reports its exit code
+                break
 
-    # write first file to mapper
-    if not abort_event.is_set() and not write_file_to_descriptor(input_queue, map_process.stdin):
-        abort_event.set()
-        return
+def is_cancelled(map_process, speculator):
+    """ returns True if map_process was stopped because another attempt processed its file first """
+    return speculator is not None and map_process in speculator.cancelled
+
+def worker_stderr_read_thread(config, processed_files_queue, input_queue, map_process, abort_event, speculator):
+    check_map_process(map_process, abort_event, speculator)
+
+    # write first files to mapper
+    in_flight = []
+    stdin_open = not abort_event.is_set() and dispatch_files(config, input_queue, map_process.stdin, in_flight, speculator, map_process)
 
     for line in iter(map_process.stderr.readline, ""):
-        line = line.rstrip() # remove trailing linebreak
-        splt = line.split(",", 2)
-        if len(splt) != 3:
-            add_message("invalid message received from mapper: {}".format(line))
-        else:
-            file_status, file_size, file_name = splt
-            if file_status == "+":
-                processed_files_queue.put((file_name, int(file_size)))
-            elif file_status == "!":
-                add_message("error processing {}, requeuing...".format(file_name))
-                input_queue.put(file_name) # re-queue file
-            else:
-                add_message("invalid status received from mapper: {}".format(file_status))
-
-        if abort_event.is_set() or not write_file_to_descriptor(input_queue, map_process.stdin):
-            break
+        process_status_line(line, processed_files_queue, input_queue, in_flight, speculator, map_process)
 
-        check_map_process(map_process, abort_event)
+        if abort_event.is_set():
+            break
+        if stdin_open:
+            # once there are no more files mapper finishes the ones it has and exits
+            stdin_open = dispatch_files(config, input_queue, map_process.stdin, in_flight, speculator, map_process)
+            if stdin_open:
+                # mapper that exits while it's still being sent files died, after its stdin is closed it exits on its own
+                check_map_process(map_process, abort_event, speculator)
 
+    requeue_files(input_queue, in_flight, speculator, map_process)
     if not abort_event.is_set():
         map_process.wait()
 
-def curses_thread(config, abort_event, map_processes, reduce_processes, window, start_time, bytes_total):
+def listing_thread(input_queue, units, file_sizes, speculator, files, listed_files):
+    queue_input_files(input_queue, units, file_sizes, speculator, listed_files)
+    if files is not None and not input_queue.error:
+        add_message(describe_units(len(files), len(file_sizes)))
+
+def curses_thread(config, abort_event, map_processes, reduce_processes, window, start_time):
     map_pids = [psutil.Process(x.pid) for x in map_processes]
     reduce_pids = [psutil.Process(x.pid) for x in reduce_processes]
     sleep_time = config.screen_refresh_interval - (config.cpu_usage_interval * (len(map_pids) + len(reduce_pids)))
@@ -75,7 +88,7 @@ def curses_thread(config, abort_event, map_processes, reduce_processes, window,
             print_pid(p, window, i, "smr-reduce")
             i += 1
 
-        add_str(window, i + 1, "job progress: {0:%}".format(get_param("bytes_processed") / bytes_total))
+        add_str(window, i + 1, "job progress: {0:%}".format(get_param("bytes_processed") / max(get_param("bytes_total"), 1)))
         add_str(window, i + 2, "last file processed: {}".format(get_param("last_file_processed")))
         messages = get_param("messages")[-10:]
         if len(messages) > 0:
@@ -89,57 +102,107 @@ def curses_thread(config, abort_event, map_processes, reduce_processes, window,
 
 def run(config):
     configure_job(config)
+    journal = get_journal(config)
+    state = get_incremental_state(config)
+    # workers are forked from a process that's forked before any threads are started
+    fork_server = get_fork_server(config)
     print("getting list of the files to process...")
-    bytes_total, file_names = get_uris(config)
-    files_total = len(file_names)
-    if files_total <= 0:
+    file_sizes = {}
+    listed_files = []
+    files = None
+    if config.schedule == "listing" and not (state and state.files):
+        # mappers start on the first files while the rest of them are still being listed
+        files = listed_files
+        units = list_units(config, listed_files)
+    else:
+        # incremental job needs every file listed to find out whether the ones it processed before changed
+        _, file_names = get_uris(config, file_sizes, listed_files)
+        units = [(file_name, file_sizes[file_name]) for file_name in file_names]
+    processed = get_processed_files(listed_files, journal, state)
+    if processed:
+        units = skip_processed(units, processed)
+        files = None # number of listed files isn't the number of files to process anymore
+    units = iter(units)
+    first_unit = next(units, None)
+    if first_unit is not None:
+        units = itertools.chain([first_unit], units)
+    elif state and state.snapshots:
+        print("no new files since the last run")
+    else:
         print("no files to process")
         sys.exit(1)
 
-    input_queue = Queue(files_total)
-    for file_name in file_names:
-        input_queue.put(file_name)
-    output_queue = Queue()
-    processed_files_queue = Queue(files_total)
+    input_queue = InputQueue()
+    processed_files_queue = Queue()
 
     start_time = datetime.datetime.now()
     abort_event = threading.Event()
 
+    speculator = None
+    if config.speculation_factor > 0:
+        if config.direct_reduce:
+            # output that mappers wrote straight into reducers can't be taken back
+            print("speculative execution is not supported with --direct-reduce, disabling it")
+            config.speculation_factor = 0
+        else:
+            speculator = Speculator(config, input_queue, file_sizes, abort_event, lambda map_process: map_process.terminate())
+    # mappers send output of each file in one piece, so that smr knows when all of it was queued
+    config.attempt_output = speculator is not None or journal is not None
+
+    lister = threading.Thread(target=listing_thread, args=(input_queue, units, file_sizes, speculator, files, listed_files))
+    lister.daemon = True
+    lister.start()
+
+    if not config.output_filename:
+        config.output_filename = "results/{}.{}.out".format(os.path.basename(config.config), datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
+    ensure_dir_exists(config.output_filename)
+
+    direct_outputs = []
+    if config.direct_reduce:
+        # mappers write straight into reducers' FIFOs, smr only reads their stderr
+        direct_outputs = create_direct_outputs(config)
+        reducers = start_reducers(config, abort_event, direct_outputs, fork_server)
+        config.direct_output = [fifo_path for fifo_path, _, _ in direct_outputs]
+        map_stdout = os.devnull
+        mappers_done_event = threading.Event()
+        direct_reducers_worker = threading.Thread(target=direct_reducers_thread, args=(reducers, abort_event, mappers_done_event))
+        direct_reducers_worker.daemon = True
+        direct_reducers_worker.start()
+    else:
+        reducers = start_reducers(config, abort_event, fork_server=fork_server)
+        map_stdout = subprocess.PIPE
+    output_queues = [output_queue for _, _, output_queue, _ in reducers if output_queue]
+    restore_reducers(output_queues, journal, state)
+    if journal:
+        journal_worker = threading.Thread(target=journal_thread, args=(journal, output_queues, abort_event))
+        journal_worker.daemon = True
+        journal_worker.start()
+
     map_args = get_args("smr-map", config)
 
     map_processes = []
     read_workers = []
     for _ in xrange(config.workers):
-        map_process = subprocess.Popen(map_args, bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        map_process = start_process(fork_server, map_args, subprocess.PIPE, map_stdout, subprocess.PIPE)
         map_processes.append(map_process)
 
-        row = threading.Thread(target=worker_stdout_read_thread, args=(output_queue, map_process, abort_event))
-        row.daemon = True
-        row.start()
+        if not config.direct_reduce:
+            row = threading.Thread(target=worker_stdout_read_thread, args=(config, output_queues, map_process, abort_event, speculator, journal))
+            row.daemon = True
+            row.start()
 
-        rew = threading.Thread(target=worker_stderr_read_thread, args=(processed_files_queue, input_queue, map_process, abort_event))
+        rew = threading.Thread(target=worker_stderr_read_thread, args=(config, processed_files_queue, input_queue, map_process, abort_event, speculator))
         rew.daemon = True
         rew.start()
         read_workers.append(rew)
 
-    if not config.output_filename:
-        config.output_filename = "results/{}.{}.out".format(os.path.basename(config.config), datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f"))
-    ensure_dir_exists(config.output_filename)
-
-    reduce_stdout = open(config.output_filename, "w")
-    reduce_process = subprocess.Popen(get_args("smr-reduce", config), bufsize=0, stdin=subprocess.PIPE, stdout=reduce_stdout, stderr=subprocess.PIPE)
-
-    reduce_worker = threading.Thread(target=reduce_thread, args=(reduce_process, output_queue, abort_event))
-    #reduce_worker.daemon = True
-    reduce_worker.start()
-
     progress_worker = threading.Thread(target=progress_thread, args=(processed_files_queue, abort_event))
     #progress_worker.daemon = True
     progress_worker.start()
 
     if config.output_job_progress:
         window = curses.initscr()
-        curses_worker = threading.Thread(target=curses_thread, args=(config, abort_event, map_processes, [reduce_process], window, start_time, bytes_total))
+        curses_worker = threading.Thread(target=curses_thread, args=(config, abort_event, map_processes, [x[0] for x in reducers], window, start_time))
         #curses_worker.daemon = True
         curses_worker.start()
 
@@ -151,11 +214,38 @@ def run(config):
         if config.output_job_progress:
             curses.endwin()
         print("user aborted. elapsed time: {}".format(str(datetime.datetime.now() - start_time)))
-        print("partial results are in {}".format(config.output_filename))
+        print("partial results are in {}".format(get_partial_results_location(config)))
+        if journal:
+            print("run it again with --resume to continue from the last checkpoint in {}".format(config.journal))
+        sys.exit(1)
+
+    if config.direct_reduce:
+        for map_process in map_processes:
+            if abort_event.is_set() and map_process.poll() is None:
+                map_process.terminate() # reducers won't see EOF while mappers are running
+            map_process.wait()
+        mappers_done_event.set() # reducers exit once their FIFOs are closed
+        direct_reducers_worker.join()
+        close_direct_outputs(direct_outputs)
+
+    if input_queue.error:
+        abort_event.set()
+        if config.output_job_progress:
+            curses_worker.join()
+            curses.endwin()
+        remove_direct_outputs(direct_outputs)
+        print("could not list files to process: {}".format(input_queue.error))
+        print("partial results are in {}".format(get_partial_results_location(config)))
         sys.exit(1)
 
     if not abort_event.is_set():
-        output_queue.join() # wait for reducer to process everything
+        for output_queue in output_queues:
+            output_queue.join() # wait for reducers to process everything
+        mappers_succeeded = all(map_process.returncode == 0 or is_cancelled(map_process, speculator) for map_process in map_processes)
+        if state and not (mappers_succeeded and input_queue.empty()):
+            print("not every file was processed, state of the job in {} was not updated".format(config.incremental))
+        elif state and not state.save(output_queues, abort_event, get_completed_files(listed_files, processed)):
+            print("could not save state of the job in {}".format(config.incremental))
         abort_event.set()
 
     if config.output_job_progress:
@@ -163,22 +253,20 @@ def run(config):
         curses.endwin()
 
     # wait for reduce to finish before exiting
-    reduce_worker.join()
-    (_, stderr) = reduce_process.communicate()
-    if stderr:
-        sys.stderr.write(stderr)
-    if reduce_process.returncode != 0:
-        print("reduce process {} exited with code {}".format(reduce_process.pid, reduce_process.returncode))
-        print("partial results are in {}".format(config.output_filename))
+    reducers_succeeded = wait_for_reducers(config, reducers)
+    remove_direct_outputs(direct_outputs)
+    if not reducers_succeeded:
+        print("partial results are in {}".format(get_partial_results_location(config)))
         sys.exit(1)
 
     for map_process in map_processes:
-        if map_process.returncode != 0:
+        if map_process.returncode != 0 and not is_cancelled(map_process, speculator):
             print("map process {} exited with code {}".format(map_process.pid, map_process.returncode))
-            print("partial results are in {}".format(config.output_filename))
+            print("partial results are in {}".format(get_partial_results_location(config)))
+            if journal:
+                print("run it again with --resume to continue from the last checkpoint in {}".format(config.journal))
             sys.exit(1)
 
-    reduce_stdout.close()
     for message in get_param("messages"):
         print(message)
 
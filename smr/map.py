@@ -1,11 +1,374 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, division, print_function, unicode_literals
+from abc import ABCMeta, abstractmethod
+import fcntl
 from inspect import getargspec
+import json
 import os
+from Queue import Queue
 import sys
+import tempfile
+import threading
 
+from .cache import MapCache
 from .config import get_config, configure_job
-from .uri import download, cleanup
+from .shared import get_partition
+from .transport import encode_frame, write_attempt, CompressedWriter
+from .uri import download, cleanup, open_uri, parse_split, parse_batch
+
+SPOOL_MEMORY_SIZE = 64 * 1024 * 1024 # output of a file that's larger than this is spooled to disk
+
+class RecordWriter(object):
+    """
+    base class for file-like objects that replace sys.stdout while MAP_FUNC is running
+    every line printed by MAP_FUNC is passed to emit() as a record, without its trailing linebreak
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.partial_line = b""
+
+    def write(self, data):
+        lines = (self.partial_line + data).split(b"\n")
+        self.partial_line = lines.pop() # last element is either empty or a line that's not finished yet
+        for line in lines:
+            self.emit(line)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def finish_line(self):
+        """ emit whatever was printed without a trailing linebreak """
+        if self.partial_line:
+            partial_line = self.partial_line
+            self.partial_line = b""
+            self.emit(partial_line)
+
+    @abstractmethod
+    def emit(self, record):
+        """ writes out a single record """
+
+    def flush(self):
+        self.stream.flush()
+
+class CombineWriter(RecordWriter):
+    """
+    collects records from MAP_FUNC and passes them to COMBINE_FUNC in windows of up to window records,
+    records returned by COMBINE_FUNC are written to stream
+    """
+    def __init__(self, stream, combine_func, window):
+        super(CombineWriter, self).__init__(stream)
+        self.combine_func = combine_func
+        self.window = window
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(record)
+        if self.window > 0 and len(self.lines) >= self.window:
+            self.combine()
+
+    def combine(self):
+        """ pass all collected records to COMBINE_FUNC and write out its results """
+        self.finish_line()
+        if len(self.lines) > 0:
+            lines = self.lines
+            self.lines = []
+            for result in self.combine_func(lines):
+                write_record(self.stream, result)
+
+    def discard(self):
+        """ drop collected records without combining them, used when MAP_FUNC failed """
+        self.lines = []
+        self.partial_line = b""
+
+class FrameWriter(RecordWriter):
+    """ writes records to stream in frames of about frame_size bytes, used for framed transport """
+    def __init__(self, stream, frame_size):
+        super(FrameWriter, self).__init__(stream)
+        self.frame_size = frame_size
+        self.records = []
+        self.records_size = 0
+
+    def emit(self, record):
+        self.records.append(record)
+        self.records_size += len(record)
+        if self.records_size >= self.frame_size:
+            self.write_frame()
+
+    def write_frame(self):
+        if len(self.records) > 0:
+            self.stream.write(encode_frame(self.records))
+            self.records = []
+            self.records_size = 0
+
+    def flush(self):
+        self.finish_line()
+        self.write_frame()
+        self.stream.flush()
+
+class DirectWriter(RecordWriter):
+    """
+    writes records straight into FIFOs read by smr-reduce processes, used with --direct-reduce
+    records are partitioned the same way smr does it, buffered and written out in chunks of about frame_size bytes
+    while holding an exclusive lock on the FIFO, so that output of different mappers never interleaves
+    """
+    def __init__(self, config, fifo_paths):
+        super(DirectWriter, self).__init__(None)
+        self.config = config
+        self.outputs = []
+        for fifo_path in fifo_paths:
+            self.outputs.append((os.open(fifo_path, os.O_WRONLY), os.open("{}.lock".format(fifo_path), os.O_RDONLY)))
+        self.records = [[] for _ in fifo_paths]
+        self.records_size = [0 for _ in fifo_paths]
+
+    def emit(self, record):
+        if self.config.transport != "framed" and isinstance(record, unicode):
+            record = record.encode("utf-8")
+        partition = get_partition(self.config, record)
+        self.records[partition].append(record)
+        self.records_size[partition] += len(record)
+        if self.records_size[partition] >= self.config.frame_size:
+            self.write_partition(partition)
+
+    def write_partition(self, partition):
+        records = self.records[partition]
+        if len(records) == 0:
+            return
+        if self.config.transport == "framed":
+            data = encode_frame(records)
+        else:
+            data = b"\n".join(records) + b"\n"
+        self.records[partition] = []
+        self.records_size[partition] = 0
+
+        fd, lock_fd = self.outputs[partition]
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        except (IOError, OSError) as e:
+            # reducer is gone (EPIPE) and whatever was written so far is lost, this can't be retried as a single file
+            sys.stderr.write("map worker {} can't write to reducer {}: {}\n".format(os.getpid(), partition, e))
+            sys.exit(1)
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def flush(self):
+        self.finish_line()
+        for partition in xrange(len(self.outputs)):
+            self.write_partition(partition)
+
+class CacheWriter(RecordWriter):
+    """
+    passes records through to stream while writing them into the cache entry of the current file with --map-cache,
+    records of files that are cached already are replayed to stream instead
+    """
+    def __init__(self, stream, cache):
+        super(CacheWriter, self).__init__(stream)
+        self.cache = cache
+        self.entry_writer = None
+
+    def start(self, entry):
+        """ start caching records of a file that's about to be processed """
+        self.entry_writer = self.cache.writer(entry)
+
+    def emit(self, record):
+        if self.entry_writer:
+            self.entry_writer.emit(record)
+        write_record(self.stream, record)
+
+    def replay(self, entry):
+        for record in entry.read_records():
+            write_record(self.stream, record)
+
+    def commit(self):
+        """ store records of the file in the cache once it's processed successfully """
+        self.finish_line()
+        if self.entry_writer:
+            self.entry_writer.commit()
+            self.entry_writer = None
+
+    def discard(self):
+        self.partial_line = b""
+        if self.entry_writer:
+            self.entry_writer.discard()
+            self.entry_writer = None
+
+class AttemptSpool(object):
+    """
+    collects output of the current file with --attempt-output, so that it's sent to smr in one piece
+    once the file is processed successfully, and smr can keep output of just one attempt at processing each file
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+
+    def write(self, data):
+        self.spool.write(data)
+
+    def flush(self):
+        pass
+
+    def commit(self, uri):
+        """ send output collected so far to smr as output of uri """
+        write_attempt(self.stream, uri, self.spool)
+        self.stream.flush()
+        self.discard()
+
+    def discard(self):
+        self.spool.seek(0)
+        self.spool.truncate()
+
+def write_record(stream, record):
+    if isinstance(stream, RecordWriter):
+        stream.emit(record)
+    else:
+        print(record, file=stream)
+
+def emit(record):
+    """
+    send record to the reducer from MAP_FUNC, same as printing it
+    except that record can contain linebreaks when using framed transport
+    """
+    write_record(sys.stdout, record)
+
+class Downloader(object):
+    """
+    iterates over (uri, map_input, file_size, cache_entry, error) tuples for uris
+    map_input is a downloaded temp filename, or an InputStream if STREAM_INPUT is set in config
+    with --map-cache cache_entry is the CacheEntry of uri, files that are cached aren't downloaded and map_input is None,
+    file_stats has (size, etag or modification time) of every uri that smr sent
+    with config.prefetch > 0 files are downloaded by that many background threads while MAP_FUNC is processing
+    the current file, as long as files that are downloaded and not processed yet fit into config.prefetch_bytes
+    done() has to be called after each file is processed and cleaned up
+    """
+    def __init__(self, config, uris, cache=None, file_stats=None):
+        self.config = config
+        self.uris = uris
+        self.cache = cache
+        self.file_stats = file_stats
+        # there's nothing to download ahead when streaming input
+        self.prefetch = 0 if config.STREAM_INPUT else config.prefetch
+        self.uris_lock = threading.Lock()
+        # one slot for the file being processed and the rest for files being downloaded ahead of it
+        self.slots = threading.Semaphore(self.prefetch + 1)
+        self.budget = threading.Condition()
+        self.prefetched_bytes = 0
+        self.downloads = Queue()
+        self.threads_running = self.prefetch
+        for _ in xrange(self.prefetch):
+            download_thread = threading.Thread(target=self.download_thread)
+            download_thread.daemon = True
+            download_thread.start()
+
+    def download(self, uri):
+        cache_entry = None
+        try:
+            if self.cache:
+                file_size, file_version = self.file_stats.pop(uri)
+                cache_entry = self.cache.get(uri, file_version)
+                if cache_entry.output:
+                    return uri, None, file_size, cache_entry, None
+            if self.config.STREAM_INPUT:
+                input_stream, file_size = open_uri(self.config, uri)
+                return uri, input_stream, file_size, cache_entry, None
+            temp_filename = download(self.config, uri)
+            _, start, end = parse_split(uri)
+            # progress of splits is tracked by their size in the original file
+            file_size = os.path.getsize(temp_filename) if start is None else end - start
+            return uri, temp_filename, file_size, cache_entry, None
+        except Exception as e:
+            return uri, None, 0, cache_entry, e
+
+    def next_uri(self):
+        with self.uris_lock:
+            return next(self.uris, None)
+
+    def download_thread(self):
+        while True:
+            self.slots.acquire()
+            with self.budget:
+                while self.prefetched_bytes >= self.config.prefetch_bytes:
+                    self.budget.wait()
+            uri = self.next_uri()
+            if uri is None:
+                self.slots.release()
+                break
+            result = self.download(uri)
+            with self.budget:
+                self.prefetched_bytes += result[2]
+            self.downloads.put(result)
+
+        with self.budget:
+            self.threads_running -= 1
+            if self.threads_running == 0:
+                self.downloads.put(None) # no more files
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            return (self.download(uri) for uri in self.uris)
+        return iter(self.downloads.get, None)
+
+    def cleanup(self, uri, map_input):
+        if self.config.STREAM_INPUT:
+            map_input.close()
+        else:
+            cleanup(uri, map_input)
+
+    def done(self, file_size):
+        if self.prefetch <= 0:
+            return
+        with self.budget:
+            self.prefetched_bytes -= file_size
+            self.budget.notify_all()
+        self.slots.release()
+
+class StatusReporter(object):
+    """
+    keeps track of file statuses that are reported to smr
+    statuses of files that came in a batch are collected and reported in a single message
+    once every file in that batch is processed
+    """
+    def __init__(self):
+        self.batches = {} # uri -> (uris, statuses) of the batch that uri belongs to
+
+    def get_uris(self, units):
+        """ yields every uri in units, remembering which batch each of them belongs to """
+        for unit in units:
+            uris = parse_batch(unit)
+            if len(uris) > 1:
+                statuses = {}
+                for uri in uris:
+                    self.batches[uri] = (uris, statuses)
+            for uri in uris:
+                yield uri
+
+    def add(self, file_status, file_size, uri):
+        """ returns a (status, size, file name) message for smr, or None if the rest of the batch isn't done yet """
+        if uri not in self.batches:
+            return file_status, file_size, uri
+        uris, statuses = self.batches.pop(uri)
+        statuses[uri] = (file_status, file_size, uri)
+        if len(statuses) < len(set(uris)):
+            return None
+        # statuses are reported in the same order as files in the batch, so that smr knows which batch it was
+        return "*", sum(x[1] for x in statuses.itervalues()), json.dumps([statuses[x] for x in uris])
+
+def read_units(lines, file_stats):
+    """
+    yields units that smr sent in lines, with --map-cache every line is a JSON list of the unit and
+    [size, etag or modification time] of every file or split in it, which are added to file_stats
+    """
+    for line in lines:
+        if file_stats is None:
+            yield line
+            continue
+        unit, stats = json.loads(line)
+        for uri, (file_size, file_version) in stats.iteritems():
+            file_stats[uri.encode("utf-8")] = (file_size, file_version)
+        yield unit.encode("utf-8") # same as the lines that come without --map-cache
 
 def write_to_stderr(file_status, file_size, file_name):
     sys.stderr.write("{},{},{}\n".format(file_status, file_size, file_name))
@@ -13,32 +376,83 @@ def write_to_stderr(file_status, file_size, file_name):
 
 def run(config):
     configure_job(config)
+    stdout = sys.stdout
+    output = stdout
+    attempt_spool = None
+    compressed_output = None
+    if config.compress_output and not config.direct_output:
+        output = compressed_output = CompressedWriter(stdout, config.compress_output)
+    if config.direct_output:
+        output = DirectWriter(config, config.direct_output)
+    else:
+        if config.attempt_output:
+            output = attempt_spool = AttemptSpool(output)
+        if config.transport == "framed":
+            output = FrameWriter(output, config.frame_size)
+    cache = None
+    cache_writer = None
+    if config.map_cache:
+        cache = MapCache(config)
+        output = cache_writer = CacheWriter(output, cache)
+    combine_writer = None
+    if config.COMBINE_FUNC:
+        output = combine_writer = CombineWriter(output, config.COMBINE_FUNC, config.combine_window)
+    # allow passing uri to mapper, without breaking existing code
+    pass_uri = len(getargspec(config.MAP_FUNC).args) == 2
+    reporter = StatusReporter()
+    file_stats = {} if cache else None
+    lines = (line.rstrip() for line in iter(sys.stdin.readline, "")) # remove trailing linebreak
+    downloader = Downloader(config, reporter.get_uris(read_units(lines, file_stats)), cache, file_stats)
     try:
-        for uri in iter(sys.stdin.readline, ""):
-            uri = uri.rstrip() # remove trailing linebreak
-            temp_filename = None
+        for uri, map_input, file_size, cache_entry, error in downloader:
             try:
-                temp_filename = download(config, uri)
-                file_size = os.path.getsize(temp_filename)
-                # allow passing uri to mapper, without breaking existing code
-                if len(getargspec(config.MAP_FUNC).args) == 2:
-                    config.MAP_FUNC(temp_filename, uri)
+                if error:
+                    raise error
+                sys.stdout = output
+                if cache_entry and cache_entry.output:
+                    cache_writer.replay(cache_entry)
                 else:
-                    config.MAP_FUNC(temp_filename)
-                write_to_stderr("+", file_size, uri)
+                    if cache_entry:
+                        cache_writer.start(cache_entry)
+                    if pass_uri:
+                        config.MAP_FUNC(map_input, parse_split(uri)[0]) # every split of a file gets the file's uri
+                    else:
+                        config.MAP_FUNC(map_input)
+                    if combine_writer:
+                        combine_writer.combine() # combine whatever is left from this file
+                    if cache_writer:
+                        cache_writer.commit()
+                if attempt_spool:
+                    output.flush()
+                    attempt_spool.commit(uri)
+                message = reporter.add("+", file_size, uri)
             except (KeyboardInterrupt, SystemExit):
                 sys.stderr.write("map worker {} aborted\n".format(os.getpid()))
                 sys.exit(1)
             except Exception as e:
+                if combine_writer:
+                    combine_writer.discard()
+                if cache_writer:
+                    cache_writer.discard()
+                if attempt_spool:
+                    output.flush()
+                    attempt_spool.discard() # smr never gets partial output of a file that failed
                 sys.stderr.write("{}\n".format(e))
-                write_to_stderr("!", 0, uri)
+                message = reporter.add("!", 0, uri)
             finally:
-                sys.stdout.flush() # force stdout flush after every file processed
-                if temp_filename:
-                    cleanup(uri, temp_filename)
+                sys.stdout = stdout
+                if map_input:
+                    downloader.cleanup(uri, map_input)
+                downloader.done(file_size)
+
+            if message:
+                output.flush() # force stdout flush after every file or batch processed, before reporting it
+                write_to_stderr(*message)
     except (KeyboardInterrupt, SystemExit):
         sys.stderr.write("map worker {} aborted\n".format(os.getpid()))
         sys.exit(1)
+    if compressed_output:
+        compressed_output.close()
 
 def main():
     config = get_config()
@@ -1,14 +1,187 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, division, print_function, unicode_literals
+import base64
+import cPickle as pickle
+import itertools
+import os
+import select
 import sys
+import time
 
 from .config import get_config, configure_job
+from .spill import configure_spilling, sort_records
+from .transport import CONTROL_PREFIX, FRAME_HEADER, read_frame, decode_frame, read_records, parse_control, \
+    encode_control, CompressedWriter
+
+BATCH_READ_SIZE = 1024 * 1024 # how much of stdin is read at once for REDUCE_BATCH_FUNC, in bytes
+
+def get_records(config, stream):
+    if config.transport == "framed":
+        return read_records(stream)
+    # remove trailing linebreak
+    return (line.rstrip() for line in iter(stream.readline, ""))
+
+def read_line_batches(stream, controlled):
+    """
+    yields lists of lines without trailing whitespace read from stream in chunks of BATCH_READ_SIZE bytes,
+    the same as get_records returns them. with controlled every line that looks like a control record is yielded
+    as a list of its own
+    """
+    fd = stream.fileno()
+    partial = [] # chunks of a line that's not finished yet, lines can be longer than a chunk
+    while True:
+        # os.read returns whatever is available, so smr doesn't wait for a snapshot while reducer waits for more input
+        chunk = os.read(fd, BATCH_READ_SIZE)
+        if not chunk:
+            break
+        partial.append(chunk)
+        if b"\n" not in chunk:
+            continue
+        data = b"".join(partial)
+        lines = data.split(b"\n")
+        partial = [lines.pop()]
+        lines = [line.rstrip() for line in lines]
+        if not controlled or CONTROL_PREFIX not in data:
+            yield lines
+            continue
+        batch = []
+        for line in lines:
+            if line.startswith(CONTROL_PREFIX):
+                if batch:
+                    yield batch
+                    batch = []
+                yield [line]
+            else:
+                batch.append(line)
+        if batch:
+            yield batch
+    partial = b"".join(partial).rstrip()
+    if partial:
+        yield [partial]
+
+def get_batches(config, stream, controlled):
+    """ yields lists of records for REDUCE_BATCH_FUNC, with framed transport every frame is a batch """
+    if config.transport == "framed":
+        return (decode_frame(frame) for frame in iter(lambda: read_frame(stream), None))
+    return read_line_batches(stream, controlled)
+
+def group_records(records):
+    """ yields (key, values) tuples of "key\tvalue" records sorted by key, values is an iterator over values of the key """
+    for key, group in itertools.groupby(records, key=lambda record: record.split(b"\t", 1)[0]):
+        yield key, (record[len(key) + 1:] for record in group)
+
+def split_records(config, data):
+    """ returns records in data read from --local-input and the rest of data after the last complete record """
+    if config.transport != "framed":
+        lines = data.split(b"\n")
+        rest = lines.pop()
+        return [line.rstrip() for line in lines], rest
+    records = []
+    position = 0
+    while len(data) - position >= FRAME_HEADER.size:
+        (payload_size,) = FRAME_HEADER.unpack_from(data, position)
+        end = position + FRAME_HEADER.size + payload_size
+        if end > len(data):
+            break
+        records.extend(decode_frame(data[position:end]))
+        position = end
+    return records, data[position:]
+
+def send_partial(config, output):
+    """ sends state of a node-local reducer to smr-ec2 and resets it with RESET_FUNC """
+    state = base64.b64encode(pickle.dumps(config.SNAPSHOT_FUNC(), pickle.HIGHEST_PROTOCOL))
+    if config.RESET_FUNC:
+        config.RESET_FUNC()
+    output.write(encode_control(config.transport, "merge", state))
+    output.flush()
+
+def run_local(config):
+    """
+    runs node-local smr-reduce of smr-ec2 with --local-reduce, which reduces output that mappers on the same instance
+    write into --local-input FIFO and sends reducer's state to smr-ec2 as a partial aggregate, merged into its
+    reducer with RESTORE_FUNC. with RESET_FUNC it's sent every --local-reduce-interval seconds, otherwise only
+    once smr-ec2 closes stdin after all of the mappers exited
+    """
+    # FIFO is opened for writing as well, so that it doesn't end when mappers that are writing into it exit
+    input_fd = os.open(config.local_input, os.O_RDWR)
+    stdin_fd = sys.stdin.fileno()
+    output = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    if config.compress_output:
+        output = CompressedWriter(output, config.compress_output)
+    sys.stdout = sys.stderr # anything reducer prints would corrupt partials
+    rest = b""
+    reduced = False
+    next_flush = time.time() + config.local_reduce_interval
+    done = False
+    while not done:
+        readable, _, _ = select.select([input_fd, stdin_fd], [], [], max(next_flush - time.time(), 0))
+        if stdin_fd in readable and not os.read(stdin_fd, 4096):
+            done = True
+            readable, _, _ = select.select([input_fd], [], [], 0)
+        while input_fd in readable:
+            records, rest = split_records(config, rest + os.read(input_fd, BATCH_READ_SIZE))
+            if records:
+                if config.REDUCE_BATCH_FUNC:
+                    config.REDUCE_BATCH_FUNC(records)
+                else:
+                    for record in records:
+                        config.REDUCE_FUNC(record)
+                reduced = True
+            # once mappers exited, everything they wrote is read before the last partial is sent
+            readable = select.select([input_fd], [], [], 0)[0] if done else []
+        if reduced and (done or (config.RESET_FUNC and time.time() >= next_flush)):
+            send_partial(config, output)
+            reduced = False
+        if time.time() >= next_flush:
+            next_flush = time.time() + config.local_reduce_interval
+    if config.compress_output:
+        output.close()
+
+def run_control(config, command, argument):
+    """ handles a control record that smr sent in between map output """
+    if command == "checkpoint":
+        # snapshot is written under a temporary name, smr takes the final one as a sign that it's complete
+        temp_path = "{}.tmp".format(argument)
+        with open(temp_path, "wb") as f:
+            pickle.dump(config.SNAPSHOT_FUNC(), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, argument)
+    elif command == "restore":
+        with open(argument, "rb") as f:
+            config.RESTORE_FUNC(pickle.load(f))
+    elif command == "merge":
+        # partial aggregate of a node-local reducer with smr-ec2 --local-reduce
+        config.RESTORE_FUNC(pickle.loads(base64.b64decode(argument)))
+    else:
+        sys.stderr.write("invalid control record received from smr: {}\n".format(command))
 
 def run(config):
     configure_job(config)
+    configure_spilling(config.reduce_memory_limit, config.spill_dir)
+    if config.local_input:
+        run_local(config)
+        return
+    # smr only sends control records to jobs that can take snapshots
+    controlled = config.SNAPSHOT_FUNC is not None
     try:
-        for result in iter(sys.stdin.readline, ""):
-            result = result.rstrip() # remove trailing linebreak
+        if config.GROUP_BY_KEY:
+            # every record that starts with "key\t" sorts next to the others, so each key is a single group
+            for key, values in group_records(sort_records(get_records(config, sys.stdin))):
+                config.REDUCE_FUNC(key, values)
+            return
+        if config.REDUCE_BATCH_FUNC:
+            for batch in get_batches(config, sys.stdin, controlled):
+                # control records are never batched together with map output
+                control = parse_control(batch[0]) if controlled and len(batch) == 1 else None
+                if control:
+                    run_control(config, *control)
+                    continue
+                config.REDUCE_BATCH_FUNC(batch)
+            return
+        for result in get_records(config, sys.stdin):
+            control = parse_control(result) if controlled else None
+            if control:
+                run_control(config, *control)
+                continue
             config.REDUCE_FUNC(result)
     except (KeyboardInterrupt, SystemExit):
         pass
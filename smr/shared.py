@@ -1,34 +1,260 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
+import bisect
 import boto
 import curses
+import fcntl
+import heapq
+import json
 import os
-from Queue import Empty
+from Queue import Empty, Queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from .transport import encode_frame, decode_frame, read_frame, read_attempt, encode_control
+from .uri import parse_batch, parse_split
 
 GLOBAL_SHARED_DATA = {
     "files_processed": 0,
     "bytes_processed": 0,
+    "bytes_total": 0,
     "last_file_processed": "",
-    "messages": []
+    "messages": [],
+    "processed_units": set() # files, splits and files of batches that smr-map reported as processed
 }
 
+REDUCE_WRITE_BATCH = 1000 # maximum number of queued results written to reducer at once
+ATTEMPT_MEMORY_SIZE = 64 * 1024 * 1024 # output of an attempt that's larger than this is spooled to disk
+
 def reduce_thread(reduce_process, output_queue, abort_event):
     while not abort_event.is_set():
         try:
-            # result has a trailing linebreak
-            result = output_queue.get(timeout=2)
+            # each result is either a line with a trailing linebreak or a whole frame
+            results = [output_queue.get(timeout=2)]
+            while len(results) < REDUCE_WRITE_BATCH:
+                try:
+                    results.append(output_queue.get_nowait())
+                except Empty:
+                    break
             if reduce_process.poll() is not None:
                 # don't want to write if process has already terminated
                 abort_event.set()
                 break
-            reduce_process.stdin.write(result)
+            reduce_process.stdin.write(b"".join(results))
             reduce_process.stdin.flush()
-            output_queue.task_done()
+            for _ in results:
+                output_queue.task_done()
         except Empty:
             pass
     # we're calling communicate() on the process, which flushes stdin
     # so we can't close it here
     #reduce_process.stdin.close()
 
+def get_partition(config, line):
+    """ returns index of the reducer that a line or a record of map output should be sent to """
+    if config.reducers <= 1:
+        return 0
+    line = line.rstrip() # remove trailing linebreak
+    if config.PARTITION_FUNC:
+        key = config.PARTITION_FUNC(line)
+    elif config.GROUP_BY_KEY:
+        key = line.split(b"\t", 1)[0] # every value of a key has to be reduced by the same reducer
+    else:
+        key = line
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    # crc32 is stable across processes and runs, unlike hash()
+    return (zlib.crc32(key) & 0xffffffff) % config.reducers
+
+def queue_records(config, output_queues, stream):
+    """ reads lines or frames from stream until it ends and puts them into output queues of the reducers """
+    if config.transport == "framed":
+        for frame in iter(lambda: read_frame(stream), None):
+            if len(output_queues) == 1:
+                output_queues[0].put(frame) # no need to decode frames if there's only one reducer
+                continue
+            partitions = {}
+            for record in decode_frame(frame):
+                partitions.setdefault(get_partition(config, record), []).append(record)
+            for partition, records in partitions.iteritems():
+                output_queues[partition].put(encode_frame(records))
+    else:
+        for line in iter(stream.readline, ""):
+            output_queues[get_partition(config, line)].put(line)
+
+def queue_map_output(config, output_queues, stream, speculator=None, journal=None):
+    """ reads map output from stream until it ends and puts it into output queues of the reducers """
+    if not config.attempt_output:
+        queue_records(config, output_queues, stream)
+        return
+    # output of each file comes in one piece, only the first complete attempt at processing a file is kept
+    attempt_output = tempfile.SpooledTemporaryFile(max_size=ATTEMPT_MEMORY_SIZE)
+    while True:
+        attempt_output.seek(0)
+        attempt_output.truncate()
+        file_name = read_attempt(stream, attempt_output)
+        if file_name is None:
+            break
+        if speculator and not speculator.commit(file_name):
+            continue
+        attempt_output.seek(0)
+        if journal:
+            # a checkpoint can't be taken while only a part of this file's output is queued
+            with journal.lock:
+                queue_records(config, output_queues, attempt_output)
+                journal.queued(file_name)
+        else:
+            queue_records(config, output_queues, attempt_output)
+
+def get_partition_filename(config, partition):
+    if config.reducers <= 1:
+        return config.output_filename
+    return "{}.part{}".format(config.output_filename, partition)
+
+def get_partial_results_location(config):
+    if config.reducers <= 1:
+        return config.output_filename
+    return "{}.part*".format(config.output_filename)
+
+def create_direct_outputs(config):
+    """
+    creates a FIFO along with its lock file for every reducer, used with --direct-reduce
+    returns a list of (fifo_path, read_fd, write_fd) tuples
+    write_fd has to stay open until all mappers exit, otherwise reducers could see EOF too early
+    """
+    fifo_dir = tempfile.mkdtemp(prefix="smr")
+    direct_outputs = []
+    for partition in xrange(max(config.reducers, 1)):
+        fifo_path = os.path.join(fifo_dir, "reduce{}".format(partition))
+        os.mkfifo(fifo_path)
+        open("{}.lock".format(fifo_path), "w").close()
+        # opening FIFO for writing blocks until there's a reader, so open reading end first without blocking
+        read_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        write_fd = os.open(fifo_path, os.O_WRONLY)
+        fcntl.fcntl(read_fd, fcntl.F_SETFL, fcntl.fcntl(read_fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        direct_outputs.append((fifo_path, read_fd, write_fd))
+    return direct_outputs
+
+def close_direct_outputs(direct_outputs):
+    """ lets reducers see EOF once mappers close their end of FIFOs as well """
+    for _, _, write_fd in direct_outputs:
+        os.close(write_fd)
+
+def remove_direct_outputs(direct_outputs):
+    if len(direct_outputs) > 0:
+        shutil.rmtree(os.path.dirname(direct_outputs[0][0]), ignore_errors=True)
+
+def start_process(fork_server, args, stdin=None, stdout=None, stderr=None):
+    """
+    starts a worker with args, forked from fork_server or as a new process if it's None
+    each of stdin, stdout and stderr is either subprocess.PIPE, a path to open or None to inherit it from smr
+    """
+    if fork_server:
+        return fork_server.spawn(args, stdin, stdout, stderr)
+    files = []
+    streams = []
+    for stream, mode in ((stdin, "rb"), (stdout, "wb"), (stderr, "wb")):
+        if stream is None or stream == subprocess.PIPE:
+            streams.append(stream)
+        else:
+            files.append(open(stream, mode))
+            streams.append(files[-1])
+    try:
+        # close_fds so workers don't hold on to each other's pipes, otherwise they would never see EOF
+        return subprocess.Popen(args, bufsize=0, stdin=streams[0], stdout=streams[1], stderr=streams[2], close_fds=True)
+    finally:
+        for f in files:
+            f.close()
+
+def start_reducers(config, abort_event, direct_outputs=None, fork_server=None):
+    """
+    starts config.reducers smr-reduce processes, each writing its own partition of the results,
+    and threads feeding them from their own output queues
+    with direct_outputs reducers read their FIFOs instead and there are no output queues or threads
+    with fork_server reducers are forked from it instead of running new processes
+    returns a list of (reduce_process, partition_filename, output_queue, reduce_worker) tuples
+    """
+    reducers = []
+    for partition in xrange(max(config.reducers, 1)):
+        partition_filename = get_partition_filename(config, partition)
+        reduce_stdin = direct_outputs[partition][0] if direct_outputs else subprocess.PIPE
+        reduce_process = start_process(fork_server, get_args("smr-reduce", config), reduce_stdin, partition_filename, subprocess.PIPE)
+        if direct_outputs:
+            os.close(direct_outputs[partition][1]) # reducer has its own reading end now
+            reducers.append((reduce_process, partition_filename, None, None))
+            continue
+
+        output_queue = Queue()
+        reduce_worker = threading.Thread(target=reduce_thread, args=(reduce_process, output_queue, abort_event))
+        #reduce_worker.daemon = True
+        reduce_worker.start()
+        reducers.append((reduce_process, partition_filename, output_queue, reduce_worker))
+    return reducers
+
+def wait_for_reducers(config, reducers):
+    """
+    waits for all reduce processes to finish and merges their partitions into config.output_filename
+    returns True if and only if all of them were successful
+    """
+    success = True
+    for reduce_process, _, _, reduce_worker in reducers:
+        if reduce_worker:
+            reduce_worker.join()
+        (_, stderr) = reduce_process.communicate()
+        if stderr:
+            sys.stderr.write(stderr)
+        if reduce_process.returncode != 0:
+            print("reduce process {} exited with code {}".format(reduce_process.pid, reduce_process.returncode))
+            success = False
+
+    if success and len(reducers) > 1:
+        merge_partitions(config, len(reducers))
+    return success
+
+def merge_partitions(config, num_partitions):
+    """ passes all partitions to MERGE_RESULTS_FUNC, its output is written to config.output_filename """
+    partition_filenames = [get_partition_filename(config, partition) for partition in xrange(num_partitions)]
+    partition_files = [open(partition_filename) for partition_filename in partition_filenames]
+    stdout = sys.stdout
+    try:
+        with open(config.output_filename, "w") as output_file:
+            sys.stdout = output_file
+            config.MERGE_RESULTS_FUNC(partition_files)
+    finally:
+        sys.stdout = stdout
+        for partition_file in partition_files:
+            partition_file.close()
+
+    for partition_filename in partition_filenames:
+        os.unlink(partition_filename)
+
+def merge_sorted(partition_files, key=None):
+    """
+    k-way merge of partition_files, each of which is sorted by key
+    yields lines of all partitions in sorted order
+    """
+    if key is None:
+        key = lambda line: line
+    heap = []
+    for i, partition_file in enumerate(partition_files):
+        lines = iter(partition_file)
+        for line in lines:
+            heap.append((key(line), i, line, lines))
+            break
+    heapq.heapify(heap)
+    while heap:
+        _, i, line, lines = heap[0]
+        yield line
+        for line in lines:
+            heapq.heapreplace(heap, (key(line), i, line, lines))
+            break
+        else:
+            heapq.heappop(heap)
+
 def print_pid(process, window, line_num, process_name):
     try:
         cpu_percent = process.cpu_percent(0.1)
@@ -43,6 +269,40 @@ def add_str(window, line_num, str):
     except curses.error:
         pass
 
+class InputQueue(Queue):
+    """
+    queue of files to process, which mappers start on while the rest of the files are still being listed
+    listed is set once every file was put into the queue, or listing failed with error
+    """
+    def __init__(self):
+        Queue.__init__(self)
+        self.listed = threading.Event()
+        self.error = None
+        self.file_stats = {} # file name -> (size, etag or modification time) of every listed file
+
+def queue_input_files(input_queue, units, file_sizes, speculator=None, files=None):
+    """
+    puts (unit, size) tuples from units into input_queue as they come, keeping track of their sizes
+    (uri, file size, etag or modification time) tuples in files that were listed so far are added to input_queue.file_stats
+    """
+    files_added = 0
+    try:
+        for unit, size in units:
+            if files is not None:
+                for file_name, file_size, file_version in files[files_added:]:
+                    input_queue.file_stats[file_name] = (file_size, file_version)
+                files_added = len(files)
+            file_sizes[unit] = size
+            GLOBAL_SHARED_DATA["bytes_total"] += size
+            if speculator:
+                speculator.add(unit)
+            input_queue.put(unit)
+    except Exception as e:
+        input_queue.error = e
+        add_message("error listing files: {}".format(e))
+    finally:
+        input_queue.listed.set()
+
 def progress_thread(processed_files_queue, abort_event):
     while not abort_event.is_set():
         try:
@@ -54,29 +314,455 @@ def progress_thread(processed_files_queue, abort_event):
         except Empty:
             pass
 
+def process_file_status(file_status, file_size, file_name, processed_files_queue, input_queue, speculator=None):
+    if file_status == "+":
+        if speculator and not speculator.succeeded(file_name):
+            return # another attempt already processed this file
+        GLOBAL_SHARED_DATA["processed_units"].add(file_name)
+        processed_files_queue.put((file_name, int(file_size)))
+    elif file_status == "!":
+        if speculator and speculator.is_processed(file_name):
+            return
+        add_message("error processing {}, requeuing...".format(file_name))
+        input_queue.put(file_name) # re-queue file
+    else:
+        add_message("invalid status received from mapper: {}".format(file_status))
+
+def process_status_line(line, processed_files_queue, input_queue, in_flight, speculator=None, worker=None):
+    """
+    handles a line that smr-map wrote to stderr: status,size,file name for a single file
+    or *,total size,json list of [status, size, file name] for every file in a batch, in the batch's order
+    the file or batch that was reported is removed from mapper's files in flight
+    """
+    line = line.rstrip() # remove trailing linebreak
+    splt = line.split(",", 2)
+    if len(splt) != 3:
+        add_message("invalid message received from mapper: {}".format(line))
+        return
+    file_status, file_size, file_name = splt
+    if file_status == "*":
+        statuses = json.loads(file_name)
+        file_name = "\t".join(x[2] for x in statuses)
+        for batch_file_status, batch_file_size, batch_file_name in statuses:
+            process_file_status(batch_file_status, batch_file_size, batch_file_name, processed_files_queue, input_queue, speculator)
+    else:
+        process_file_status(file_status, file_size, file_name, processed_files_queue, input_queue, speculator)
+    if file_name in in_flight:
+        in_flight.remove(file_name)
+        if speculator:
+            speculator.stopped(file_name, worker)
+
 def get_param(param):
     return GLOBAL_SHARED_DATA[param]
 
 def add_message(message):
     GLOBAL_SHARED_DATA["messages"].append(message)
 
-def write_file_to_descriptor(input_queue, descriptor):
+def get_dispatch_depth(config):
+    # mapper needs the files it's going to prefetch in addition to the one it's processing
+    return max(config.dispatch_depth, config.prefetch + 1)
+
+def format_unit(config, unit, file_stats):
     """
-    get item from input_queue and write it to descriptor
-    returns True if and only if it was successfully written
+    returns the line that smr-map gets for unit: just the unit, or with --map-cache a JSON list of the unit and
+    [size, etag or modification time] of every file or split in it, so that smr-map doesn't have to look them up
     """
-    try:
-        file_name = input_queue.get(timeout=2)
-        descriptor.write("{}\n".format(file_name))
-        descriptor.flush()
-        input_queue.task_done()
+    if not config.map_cache:
+        return unit
+    stats = {}
+    for uri in parse_batch(unit):
+        file_name, start, end = parse_split(uri)
+        file_size, file_version = file_stats[file_name]
+        stats[uri] = [file_size if start is None else end - start, file_version]
+    return json.dumps([unit, stats])
+
+def dispatch_files(config, input_queue, descriptor, in_flight, speculator=None, worker=None):
+    """
+    writes files from input_queue to mapper's descriptor until it has get_dispatch_depth(config) files in flight
+    with speculative execution an idle mapper gets stragglers from other mappers once input_queue is empty
+    closes descriptor once there are no more files to process and mapper has no files in flight
+    returns True if and only if descriptor is still open
+    """
+    while len(in_flight) < get_dispatch_depth(config):
+        straggler = False
+        try:
+            # don't wait for more files while this mapper still has something to do
+            file_name = input_queue.get_nowait() if in_flight else input_queue.get(timeout=2)
+        except Empty:
+            if in_flight:
+                return True
+            if not input_queue.listed.is_set():
+                continue # wait for more files to be listed
+            if speculator is None or speculator.done():
+                # no more files in queue
+                descriptor.close()
+                return False
+            # other mappers are still processing files, wait for one of them to become a straggler
+            file_name = speculator.get_straggler(worker)
+            if file_name is None:
+                continue
+            add_message("processing {} again, it's taking longer than expected...".format(file_name))
+            straggler = True
+        try:
+            descriptor.write("{}\n".format(format_unit(config, file_name, input_queue.file_stats)))
+            descriptor.flush()
+            in_flight.append(file_name)
+            if speculator and not straggler:
+                speculator.started(file_name, worker)
+        except IOError:
+            # probably bad descriptor, let another mapper process this file
+            if straggler:
+                speculator.stopped(file_name, worker)
+                return True
+            input_queue.put(file_name)
+            input_queue.task_done()
+            return True
+        if not straggler:
+            input_queue.task_done()
+    return True
+
+def requeue_files(input_queue, in_flight, speculator=None, worker=None):
+    """ requeue files that mapper exited without processing """
+    for file_name in in_flight:
+        if speculator:
+            speculator.stopped(file_name, worker)
+            if speculator.is_processed(file_name):
+                continue # another attempt processed it already
+        add_message("map worker exited before processing {}, requeuing...".format(file_name))
+        input_queue.put(file_name)
+    del in_flight[:]
+
+class Speculator(object):
+    """
+    keeps track of attempts at processing files on all mappers for speculative execution
+    once the input queue is empty, idle mappers get files that have been processed for much longer than expected
+    from the median time per byte, the first attempt to finish wins and the rest of them are cancelled
+    workers are whatever identifies a mapper, cancel_worker is called with the workers that should be stopped
+    """
+    def __init__(self, config, input_queue, file_sizes, abort_event, cancel_worker):
+        self.config = config
+        self.input_queue = input_queue
+        self.file_sizes = file_sizes
+        self.abort_event = abort_event
+        self.cancel_worker = cancel_worker
+        self.lock = threading.Lock()
+        self.attempts = {} # file name -> {worker: start time} for attempts in progress
+        self.seconds_per_byte = [] # sorted processing times of finished files
+        self.remaining = set() # files that weren't processed successfully yet
+        self.committed = set()
+        self.cancelled = set()
+
+    def add(self, file_name):
+        """ called for every file that's put into the input queue when it's listed """
+        with self.lock:
+            self.remaining.update(parse_batch(file_name))
+
+    def is_processed(self, file_name):
+        """ returns True if every file in file_name, which can be a batch, was processed successfully """
+        return not any(uri in self.remaining for uri in parse_batch(file_name))
+
+    def done(self):
+        return self.abort_event.is_set() or (self.input_queue.listed.is_set() and len(self.remaining) == 0)
+
+    def started(self, file_name, worker):
+        with self.lock:
+            self.attempts.setdefault(file_name, {})[worker] = time.time()
+
+    def stopped(self, file_name, worker):
+        """ called when worker reported the status of file_name, or exited before doing that """
+        cancelled = []
+        with self.lock:
+            attempts = self.attempts.get(file_name, {})
+            start_time = attempts.pop(worker, None)
+            if start_time is not None and self.is_processed(file_name):
+                file_size = self.file_sizes.get(file_name)
+                if file_size:
+                    bisect.insort(self.seconds_per_byte, (time.time() - start_time) / file_size)
+                # the rest of the attempts are not needed anymore
+                cancelled = attempts.keys()
+                attempts.clear()
+                self.cancelled.update(cancelled)
+            if len(attempts) == 0:
+                self.attempts.pop(file_name, None)
+        for other_worker in cancelled:
+            add_message("cancelling another attempt at processing {}...".format(file_name))
+            self.cancel_worker(other_worker)
+
+    def succeeded(self, file_name):
+        """ returns True if this is the first successful attempt at processing file_name """
+        with self.lock:
+            if file_name not in self.remaining:
+                return False
+            self.remaining.remove(file_name)
+            return True
+
+    def commit(self, file_name):
+        """ returns True if output of this attempt at processing file_name should be sent to reducers """
+        with self.lock:
+            if file_name in self.committed:
+                return False
+            self.committed.add(file_name)
+            return True
+
+    def get_straggler(self, worker):
+        """ returns file that worker should process again, or None if no file is taking longer than expected """
+        with self.lock:
+            if len(self.seconds_per_byte) == 0:
+                return None
+            median = self.seconds_per_byte[len(self.seconds_per_byte) // 2]
+            now = time.time()
+            straggler = None
+            max_overtime = 0
+            for file_name, attempts in self.attempts.iteritems():
+                file_size = self.file_sizes.get(file_name)
+                if len(attempts) != 1 or not file_size or self.is_processed(file_name):
+                    continue
+                elapsed = now - min(attempts.itervalues())
+                expected = max(self.config.speculation_factor * median * file_size, self.config.speculation_min_time)
+                if elapsed - expected > max_overtime:
+                    straggler = file_name
+                    max_overtime = elapsed - expected
+            if straggler is not None:
+                self.attempts[straggler][worker] = now
+            return straggler
+
+def get_snapshot_paths(path, snapshot_id, output_queues):
+    return ["{}.{}.snapshot{}".format(path, snapshot_id, partition) for partition in xrange(len(output_queues))]
+
+def request_snapshots(config, output_queues, snapshots):
+    """ sends every reducer a control record to write a snapshot of its state taken by SNAPSHOT_FUNC """
+    for output_queue, snapshot_path in zip(output_queues, snapshots):
+        output_queue.put(encode_control(config.transport, "checkpoint", snapshot_path))
+
+def wait_for_snapshots(snapshots, abort_event):
+    """ returns True once every snapshot is written, or False if the job was aborted before that """
+    # reducers rename their snapshot once it's written
+    while not all(os.path.exists(snapshot_path) for snapshot_path in snapshots):
+        if abort_event.wait(1):
+            return False
+    return True
+
+def restore_snapshots(config, output_queues, snapshots):
+    """ sends every reducer a control record to add the state in its snapshot with RESTORE_FUNC """
+    for output_queue, snapshot_path in zip(output_queues, snapshots):
+        output_queue.put(encode_control(config.transport, "restore", snapshot_path))
+
+class Journal(object):
+    """
+    records files whose output was sent to reducers along with snapshots of reducers' state, so that an aborted job
+    can be resumed without processing any file twice
+    every checkpoint_interval seconds reducers get a control record to write a snapshot taken by SNAPSHOT_FUNC,
+    and once all of them did, a JSON line with the files queued before it and the snapshots is appended to the journal
+    """
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.checkpoint_id = 0
+        self.files = [] # files queued since the last checkpoint
+        self.processed = set() # files recorded in the journal
+        self.snapshots = []
+        if config.resume:
+            self.load()
+        else:
+            open(config.journal, "w").close()
+
+    def load(self):
+        if not os.path.isfile(self.config.journal):
+            return
+        with open(self.config.journal) as f:
+            for line in f:
+                try:
+                    checkpoint = json.loads(line)
+                except ValueError:
+                    break # checkpoint that wasn't completely written
+                self.checkpoint_id = checkpoint["checkpoint"]
+                self.processed.update(checkpoint["files"])
+                self.snapshots = checkpoint["snapshots"]
+
+    def queued(self, file_name):
+        """ called with lock held after all output of file_name was put into output queues """
+        self.files.append(file_name)
+
+    def restore(self, output_queues):
+        """ restores reducers' state from the last checkpoint, has to be called before any map output is queued """
+        restore_snapshots(self.config, output_queues, self.snapshots)
+
+    def checkpoint(self, output_queues, abort_event):
+        """ takes a snapshot of every reducer's state, returns once all of them are recorded in the journal """
+        with self.lock:
+            self.checkpoint_id += 1
+            files = self.files
+            self.files = []
+            snapshots = get_snapshot_paths(self.config.journal, self.checkpoint_id, output_queues)
+            request_snapshots(self.config, output_queues, snapshots)
+
+        if not wait_for_snapshots(snapshots, abort_event):
+            return
+
+        with open(self.config.journal, "a") as f:
+            f.write("{}\n".format(json.dumps({"checkpoint": self.checkpoint_id, "files": files, "snapshots": snapshots})))
+            f.flush()
+            os.fsync(f.fileno())
+        self.processed.update(files)
+        for snapshot_path in self.snapshots:
+            if os.path.exists(snapshot_path):
+                os.unlink(snapshot_path)
+        self.snapshots = snapshots
+
+def get_journal(config):
+    """ returns Journal of the job or None if it's not journaled, exits if the job can't be journaled or resumed """
+    if not config.journal:
+        if config.resume:
+            sys.stderr.write("--resume needs the --journal of the job to resume\n")
+            sys.exit(1)
+        return None
+    if config.direct_reduce:
+        sys.stderr.write("--journal is not supported with --direct-reduce\n")
+        sys.exit(1)
+    if config.local_reduce:
+        sys.stderr.write("--journal is not supported with --local-reduce\n")
+        sys.exit(1)
+    if config.GROUP_BY_KEY:
+        sys.stderr.write("--journal is not supported with GROUP_BY_KEY\n")
+        sys.exit(1)
+    if not config.SNAPSHOT_FUNC or not config.RESTORE_FUNC:
+        sys.stderr.write("you need to provide SNAPSHOT_FUNC and RESTORE_FUNC in config to use --journal\n")
+        sys.exit(1)
+    journal = Journal(config)
+    if journal.snapshots and len(journal.snapshots) != max(config.reducers, 1):
+        sys.stderr.write("journal has snapshots of {} reducers, can't resume with {}\n".format(len(journal.snapshots), config.reducers))
+        sys.exit(1)
+    return journal
+
+def journal_thread(journal, output_queues, abort_event):
+    while not abort_event.wait(journal.config.checkpoint_interval):
+        journal.checkpoint(output_queues, abort_event)
+
+class IncrementalState(object):
+    """
+    state of an incremental job that's kept in between its runs: etag or modification time of every file that was
+    processed, and snapshots of reducers' state taken by SNAPSHOT_FUNC after processing them
+    the next run restores the snapshots with RESTORE_FUNC and only processes files that were added since then,
+    if a file that was processed before changed or is gone the state is dropped and every file is processed again
+    """
+    def __init__(self, config):
+        self.config = config
+        self.run_id = 0
+        self.files = {} # file name -> etag or modification time
+        self.snapshots = []
+        self.previous_snapshots = []
+        if os.path.isfile(config.incremental):
+            with open(config.incremental) as f:
+                state = json.load(f)
+            self.run_id = state["run"]
+            self.files = state["files"]
+            self.snapshots = state["snapshots"]
+            self.previous_snapshots = self.snapshots
+
+    def get_unchanged(self, files):
+        """ returns set of files that were processed by previous runs and didn't change since then """
+        versions = dict((file_name, file_version) for file_name, _, file_version in files)
+        changed = [file_name for file_name, file_version in self.files.iteritems() if versions.get(file_name) != file_version]
+        if changed:
+            print("{} files processed by previous runs changed or are gone, processing every file again".format(len(changed)))
+            self.files = {}
+            self.snapshots = []
+        return set(self.files)
+
+    def restore(self, output_queues):
+        """ adds state of previous runs to reducers, has to be called before any map output is queued """
+        restore_snapshots(self.config, output_queues, self.snapshots)
+
+    def save(self, output_queues, abort_event, files):
+        """
+        takes a snapshot of every reducer's state after all map output was reduced, and records it together with
+        every file in files, returns False if the job was aborted before that
+        """
+        self.run_id += 1
+        snapshots = get_snapshot_paths(self.config.incremental, self.run_id, output_queues)
+        request_snapshots(self.config, output_queues, snapshots)
+        if not wait_for_snapshots(snapshots, abort_event):
+            return False
+        state = {
+            "run": self.run_id,
+            "files": dict((file_name, file_version) for file_name, _, file_version in files),
+            "snapshots": snapshots
+        }
+        temp_path = "{}.tmp".format(self.config.incremental)
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.config.incremental)
+        for snapshot_path in self.previous_snapshots:
+            if os.path.exists(snapshot_path):
+                os.unlink(snapshot_path)
+        self.files = state["files"]
+        self.snapshots = self.previous_snapshots = snapshots
         return True
-    except Empty:
-        # no more files in queue
-        descriptor.close()
-        return False
-    except IOError:
-        return False # probably bad descriptor
+
+def get_incremental_state(config):
+    """ returns IncrementalState of the job or None if it's not incremental, exits if the job can't be incremental """
+    if not config.incremental:
+        return None
+    if config.direct_reduce:
+        sys.stderr.write("--incremental is not supported with --direct-reduce\n")
+        sys.exit(1)
+    if config.GROUP_BY_KEY:
+        sys.stderr.write("--incremental is not supported with GROUP_BY_KEY\n")
+        sys.exit(1)
+    if not config.SNAPSHOT_FUNC or not config.RESTORE_FUNC:
+        sys.stderr.write("you need to provide SNAPSHOT_FUNC and RESTORE_FUNC in config to use --incremental\n")
+        sys.exit(1)
+    state = IncrementalState(config)
+    if state.snapshots and len(state.snapshots) != max(config.reducers, 1):
+        sys.stderr.write("state of the last run has snapshots of {} reducers, can't continue with {}\n".format(len(state.snapshots), config.reducers))
+        sys.exit(1)
+    return state
+
+def get_processed_files(files, journal, state):
+    """
+    returns set of listed files that don't have to be processed: files recorded in the journal of a resumed job
+    and files that previous runs of an incremental job processed
+    """
+    processed = set()
+    if state:
+        unchanged = state.get_unchanged(files)
+        if unchanged:
+            print("run {} of incremental job, skipping {} files that were processed by previous runs".format(state.run_id + 1, len(unchanged)))
+        processed.update(unchanged)
+    if journal and journal.processed:
+        print("resuming from checkpoint {}, skipping {} files that were processed already".format(journal.checkpoint_id, len(journal.processed)))
+        processed.update(journal.processed)
+    return processed
+
+def get_completed_files(files, skipped):
+    """
+    returns (file name, size, version) tuples of listed files that were either skipped or processed by smr-map,
+    a file that was split counts as processed once any of its splits was, so this is only complete if every unit was
+    """
+    completed = skipped | GLOBAL_SHARED_DATA["processed_units"]
+    completed.update([parse_split(unit)[0] for unit in completed])
+    return [f for f in files if f[0] in completed]
+
+def restore_reducers(output_queues, journal, state):
+    """ restores reducers' state from the last checkpoint of a resumed job, or from the last run of an incremental job """
+    if journal and journal.snapshots:
+        journal.restore(output_queues) # snapshots in the journal include state of the last run already
+    elif state:
+        state.restore(output_queues)
+
+def skip_processed(units, processed):
+    """
+    yields (unit, size) tuples for files, splits and files of batches in units that are not in processed,
+    splits of a file are skipped if the whole file is in processed
+    """
+    for unit, size in units:
+        file_names = parse_batch(unit)
+        remaining = [file_name for file_name in file_names \
+                     if file_name not in processed and parse_split(file_name)[0] not in processed]
+        if remaining:
+            yield "\t".join(remaining), size * len(remaining) // len(file_names)
 
 def ensure_dir_exists(path):
     dir_name = os.path.dirname(path)
@@ -100,6 +786,41 @@ def get_args(process, config, config_path=None):
         args.append("--aws-secret-key")
         args.append(boto.config.get('Credentials', 'aws_secret_access_key'))
 
+    args.append("--combine-window")
+    args.append(str(config.combine_window))
+    args.append("--transport")
+    args.append(config.transport)
+    args.append("--frame-size")
+    args.append(str(config.frame_size))
+    if config.attempt_output:
+        args.append("--attempt-output")
+    args.append("--prefetch")
+    args.append(str(config.prefetch))
+    args.append("--prefetch-bytes")
+    args.append(str(config.prefetch_bytes))
+    args.append("--ranged-download-concurrency")
+    args.append(str(config.ranged_download_concurrency))
+    args.append("--ranged-download-threshold")
+    args.append(str(config.ranged_download_threshold))
+    args.append("--ranged-download-part-size")
+    args.append(str(config.ranged_download_part_size))
+    args.append("--reducers")
+    args.append(str(config.reducers))
+    if config.map_cache:
+        args.append("--map-cache")
+        args.append(config.map_cache)
+        args.append("--map-cache-size")
+        args.append(str(config.map_cache_size))
+    if config.reduce_memory_limit:
+        args.append("--reduce-memory-limit")
+        args.append(str(config.reduce_memory_limit))
+    if config.spill_dir:
+        args.append("--spill-dir")
+        args.append(config.spill_dir)
+    for fifo_path in config.direct_output or []:
+        args.append("--direct-output")
+        args.append(fifo_path)
+
     if not config_path:
         config_path = config.config
 
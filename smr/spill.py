@@ -0,0 +1,143 @@
+"""
+memory-bounded reducer state
+
+SpillingDict keeps partial aggregates of keys in memory until their estimated size exceeds the memory limit
+(--reduce-memory-limit of smr-reduce by default), then writes them out to a run file sorted by key in --spill-dir
+and starts over. iteritems() merges the runs with what's left in memory, so OUTPUT_RESULTS_FUNC gets every key
+once, in sorted order, without holding all of them in memory
+
+sort_records sorts map output for GROUP_BY_KEY jobs the same way: in chunks that fit in memory, merged at the end
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import heapq
+import itertools
+import sys
+import tempfile
+
+from .transport import encode_frame, read_records
+
+SPILL_SETTINGS = {"memory_limit": None, "spill_dir": None} # set by smr-reduce from its config
+SPILL_FRAME_RECORDS = 10000 # number of items in each frame of a run file
+ENTRY_SIZE = 100 # estimated memory used by a dict entry in addition to its key and value, in bytes
+RECORD_SIZE = 48 # estimated memory used by a string in a list in addition to its contents, in bytes
+SORT_MEMORY_LIMIT = 512 * 1024 * 1024 # memory used by sort_records when smr-reduce has no --reduce-memory-limit
+
+def configure_spilling(memory_limit, spill_dir):
+    """ sets memory limit and directory that SpillingDicts use unless they were given their own """
+    SPILL_SETTINGS["memory_limit"] = memory_limit
+    SPILL_SETTINGS["spill_dir"] = spill_dir
+
+def write_run(items, spill_dir):
+    """ writes sorted items to a temporary file, returns it positioned at its start """
+    run_file = tempfile.TemporaryFile(prefix="smr-spill", dir=spill_dir)
+    records = []
+    for item in items:
+        records.append(item)
+        if len(records) >= SPILL_FRAME_RECORDS:
+            run_file.write(encode_frame(records))
+            records = []
+    if records:
+        run_file.write(encode_frame(records))
+    run_file.seek(0)
+    return run_file
+
+def tag_items(items, tag):
+    """ yields (key, tag, value) tuples of (key, value) items """
+    for key, value in items:
+        yield key, tag, value
+
+class SpillingDict(object):
+    """
+    partial aggregates of keys that are spilled to disk once they use more than memory_limit bytes
+    merge_func takes two values of the same key and returns a value that combines them, e.g. operator.add.
+    keys and values have to be marshallable: numbers, strings, tuples, lists or dicts of them.
+    values are measured again whenever they're merged, but with sys.getsizeof, which doesn't count what lists,
+    tuples and dicts contain, so values that grow by holding more strings or containers are underestimated
+    """
+    def __init__(self, merge_func, memory_limit=None, spill_dir=None):
+        self.merge_func = merge_func
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.items = {}
+        self.size = 0
+        self.runs = []
+
+    def add(self, key, value):
+        items = self.items
+        if key in items:
+            # merge_func can update the old value in place, so it's measured before that
+            old_size = sys.getsizeof(items[key])
+            value = items[key] = self.merge_func(items[key], value)
+            self.size += sys.getsizeof(value) - old_size
+        else:
+            items[key] = value
+            self.size += sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_SIZE
+        memory_limit = self.memory_limit or SPILL_SETTINGS["memory_limit"]
+        if memory_limit and self.size > memory_limit:
+            self.spill()
+
+    def update(self, items):
+        """ adds every (key, value) tuple in items """
+        for key, value in items:
+            self.add(key, value)
+
+    def spill(self):
+        """ writes out everything that's in memory to a new run file """
+        if self.items:
+            self.runs.append(write_run(sorted(self.items.iteritems()), self.spill_dir or SPILL_SETTINGS["spill_dir"]))
+            self.items = {}
+            self.size = 0
+
+    def iteritems(self):
+        """ yields (key, value) tuples of every key in sorted order, merging values of the same key from all runs """
+        if not self.runs:
+            for item in sorted(self.items.iteritems()):
+                yield item
+            return
+        # run index breaks ties between equal keys, so that values are never compared
+        sources = [tag_items(read_records(run_file), i) for i, run_file in enumerate(self.runs)]
+        sources.append(tag_items(sorted(self.items.iteritems()), len(self.runs)))
+        for key, entries in itertools.groupby(heapq.merge(*sources), key=lambda entry: entry[0]):
+            value = None
+            for i, (_, _, entry_value) in enumerate(entries):
+                value = entry_value if i == 0 else self.merge_func(value, entry_value)
+            yield key, value
+        for run_file in self.runs:
+            run_file.seek(0) # runs can be merged again
+
+    def __iter__(self):
+        return (key for key, _ in self.iteritems())
+
+    def close(self):
+        """ removes run files and drops everything that's in memory """
+        for run_file in self.runs:
+            run_file.close()
+        self.runs = []
+        self.items = {}
+        self.size = 0
+
+def sort_records(records, memory_limit=None, spill_dir=None):
+    """
+    yields string records in sorted order using about memory_limit bytes of memory (--reduce-memory-limit by default),
+    records that don't fit are sorted in chunks that are written to run files in spill_dir and merged at the end
+    """
+    memory_limit = memory_limit or SPILL_SETTINGS["memory_limit"] or SORT_MEMORY_LIMIT
+    spill_dir = spill_dir or SPILL_SETTINGS["spill_dir"]
+    runs = []
+    chunk = []
+    size = 0
+    try:
+        for record in records:
+            chunk.append(record)
+            size += len(record) + RECORD_SIZE
+            if size > memory_limit:
+                chunk.sort()
+                runs.append(write_run(chunk, spill_dir))
+                chunk = []
+                size = 0
+        chunk.sort()
+        for record in heapq.merge(chunk, *[read_records(run_file) for run_file in runs]):
+            yield record
+    finally:
+        for run_file in runs:
+            run_file.close()
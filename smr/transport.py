@@ -0,0 +1,194 @@
+"""
+framed transport between smr-map and smr-reduce
+
+each frame consists of a 4 byte big-endian payload length followed by the payload: a marshalled list of records.
+records are sent as is, so unlike the default line based transport they can contain linebreaks
+
+with --attempt-output smr-map sends output of each file it processed as an attempt: a header with the length
+of the file name and of the output, followed by the file name and the output itself in whichever transport is used
+
+smr sends control records to smr-reduce in between map output, e.g. to take a snapshot of its state,
+they are records of their own in either transport that start with CONTROL_PREFIX
+
+with --compress-output smr-map output is compressed with zlib by CompressedWriter, on top of whichever transport
+is used, and decompressed by smr-ec2 with DecompressedReader
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import marshal
+import shutil
+import struct
+import zlib
+
+FRAME_HEADER = struct.Struct(b">I")
+ATTEMPT_HEADER = struct.Struct(b">IQ")
+ATTEMPT_COPY_SIZE = 1024 * 1024
+CONTROL_PREFIX = b"\x00smr:"
+COMPRESS_BLOCK_SIZE = 1024 * 1024 # how much of the output is collected before it's compressed, in bytes
+DECOMPRESS_READ_SIZE = 65536
+
+def encode_frame(records):
+    payload = marshal.dumps(records)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def decode_frame(frame):
+    """ returns list of records in a frame returned by encode_frame or read_frame """
+    return marshal.loads(frame[FRAME_HEADER.size:])
+
+def read_exactly(stream, size):
+    """ reads size bytes from stream, returns less than that only if stream ended """
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def read_frame(stream):
+    """ returns the next frame, including its header, read from stream or None if stream ended """
+    header = read_exactly(stream, FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    (payload_size,) = FRAME_HEADER.unpack(header)
+    payload = read_exactly(stream, payload_size)
+    if len(payload) < payload_size:
+        return None # truncated frame, writer must have died
+    return header + payload
+
+def read_records(stream):
+    """ yields every record of every frame in stream """
+    for frame in iter(lambda: read_frame(stream), None):
+        for record in decode_frame(frame):
+            yield record
+
+def write_attempt(stream, file_name, output):
+    """ writes everything that was written to output file object as an attempt at processing file_name """
+    output_size = output.tell()
+    file_name = file_name.encode("utf-8")
+    stream.write(ATTEMPT_HEADER.pack(len(file_name), output_size) + file_name)
+    output.seek(0)
+    shutil.copyfileobj(output, stream)
+
+def read_attempt(stream, output):
+    """
+    copies output of the next attempt in stream into output file object,
+    returns file name of the attempt or None if stream ended before the whole attempt was read
+    """
+    header = read_exactly(stream, ATTEMPT_HEADER.size)
+    if len(header) < ATTEMPT_HEADER.size:
+        return None
+    file_name_size, output_size = ATTEMPT_HEADER.unpack(header)
+    file_name = read_exactly(stream, file_name_size)
+    if len(file_name) < file_name_size:
+        return None
+    while output_size > 0:
+        chunk = read_exactly(stream, min(output_size, ATTEMPT_COPY_SIZE))
+        if not chunk:
+            return None
+        output.write(chunk)
+        output_size -= len(chunk)
+    return file_name.decode("utf-8")
+
+def encode_control(transport, command, argument):
+    """ returns control record with command and its argument, ready to be sent to smr-reduce """
+    record = CONTROL_PREFIX + "{} {}".format(command, argument).encode("utf-8")
+    if transport == "framed":
+        return encode_frame([record])
+    return record + b"\n"
+
+def parse_control(record):
+    """ returns (command, argument) tuple if record is a control record, None otherwise """
+    if not record.startswith(CONTROL_PREFIX):
+        return None
+    command, argument = record[len(CONTROL_PREFIX):].decode("utf-8").split(" ", 1)
+    return command, argument
+
+class CompressedWriter(object):
+    """
+    file-like object that compresses everything written to it into stream with zlib, in blocks of COMPRESS_BLOCK_SIZE
+    bytes. flush() writes out all of the output written so far, so that it can be decompressed right away
+    """
+    def __init__(self, stream, level):
+        self.stream = stream
+        self.compressor = zlib.compressobj(level)
+        self.pending = []
+        self.pending_size = 0
+        self.flushed = True
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= COMPRESS_BLOCK_SIZE:
+            self.compress()
+
+    def compress(self):
+        if self.pending:
+            self.stream.write(self.compressor.compress(b"".join(self.pending)))
+            self.pending = []
+            self.pending_size = 0
+            self.flushed = False
+
+    def flush(self):
+        self.compress()
+        if not self.flushed:
+            self.stream.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.flushed = True
+        self.stream.flush()
+
+    def close(self):
+        """ ends the compressed stream, stream itself is left open """
+        self.compress()
+        self.stream.write(self.compressor.flush())
+        self.stream.flush()
+
+class DecompressedReader(object):
+    """
+    file-like object that reads output of CompressedWriter with read_func, which returns up to the given number of
+    bytes as soon as any of them are available, and an empty string once the stream ended, e.g. paramiko's Channel.recv.
+    compressed_size and size are numbers of bytes read so far before and after decompressing them
+    """
+    def __init__(self, read_func):
+        self.read_func = read_func
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b""
+        self.position = 0
+        self.compressed_size = 0
+        self.size = 0
+
+    def fill(self):
+        """ replaces the buffer that was read already with newly decompressed data, returns False if stream ended """
+        data = b""
+        while not data:
+            compressed = self.read_func(DECOMPRESS_READ_SIZE)
+            if not compressed:
+                data = self.decompressor.flush()
+                if not data:
+                    return False
+                break
+            self.compressed_size += len(compressed)
+            data = self.decompressor.decompress(compressed)
+        self.size += len(data)
+        self.buffer = data
+        self.position = 0
+        return True
+
+    def read(self, size):
+        """ returns up to size bytes, less than that only if they're not decompressed yet or stream ended """
+        if self.position >= len(self.buffer) and not self.fill():
+            return b""
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        chunks = []
+        while self.position < len(self.buffer) or self.fill():
+            end = self.buffer.find(b"\n", self.position)
+            if end >= 0:
+                chunks.append(self.buffer[self.position:end + 1])
+                self.position = end + 1
+                break
+            chunks.append(self.buffer[self.position:])
+            self.position = len(self.buffer)
+        return b"".join(chunks)
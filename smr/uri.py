@@ -1,75 +1,143 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 import boto
 from boto.s3.key import Key
-from datetime import timedelta
+from datetime import datetime, timedelta
+from itertools import izip
+import json
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import shutil
 import sys
 import tempfile
+import threading
+import time
+import zlib
 
-S3_BUCKETS = {} # cache s3 buckets to re-use them
+S3_BUCKETS = threading.local() # cache s3 buckets to re-use them, separately for each thread since boto connections aren't thread-safe
+S3_RANGE_RETRIES = 3 # number of attempts to download each byte range of a file
+S3_RANGE_RETRY_DELAY = 1 # seconds to wait before retrying a byte range, doubled after every failed attempt
+RANGE_DOWNLOAD_POOLS = {} # thread pools downloading byte ranges by their size, kept for the lifetime of the process
+RANGE_DOWNLOAD_POOLS_LOCK = threading.Lock()
 
 def get_s3_bucket(bucket_name, config):
-    if bucket_name not in S3_BUCKETS:
+    buckets = getattr(S3_BUCKETS, "buckets", None)
+    if buckets is None:
+        buckets = S3_BUCKETS.buckets = {}
+    if bucket_name not in buckets:
         if config.aws_access_key and config.aws_secret_key:
             s3conn = boto.connect_s3(config.aws_access_key, config.aws_secret_key)
         else:
             s3conn = boto.connect_s3() # use local boto config or IAM profile
-        S3_BUCKETS[bucket_name] = s3conn.get_bucket(bucket_name)
-    return S3_BUCKETS[bucket_name]
+        buckets[bucket_name] = s3conn.get_bucket(bucket_name)
+    return buckets[bucket_name]
 
 def date_generator(end_date, num_days):
     for n in reversed(xrange(num_days)):
         yield end_date - timedelta(n)
 
-def get_s3_uri(m, file_names, config):
+def get_s3_uri(m, files, config):
     """
-    populates file_names list with urls that matched the regex match object
+    populates files list with (url, file size, etag) tuples for files that matched the regex match object
     returns the total filesize of all the files matched
     """
     bucket_name = m.group(1)
     path = m.group(2)
     bucket = get_s3_bucket(bucket_name, config)
     result = 0
-    if (config.start_date or config.date_range) and ("{year" in path or "{month" in path or "{day" in path):
-        for tmp_date in date_generator(config.end_date, config.date_range or ((config.end_date - config.start_date).days + 1)):
-            # +1 because we want to include end_date
-            for key in bucket.list(prefix=path.format(year=tmp_date.year, month=tmp_date.month, day=tmp_date.day)):
-                file_names.append("s3://{}/{}".format(bucket_name, key.name))
-                result += key.size
-    else:
-        for key in bucket.list(prefix=path):
-            file_names.append("s3://{}/{}".format(bucket_name, key.name))
-            result += key.size
+    for key in bucket.list(prefix=path):
+        files.append(("s3://{}/{}".format(bucket_name, key.name), key.size, key.etag.strip('"')))
+        result += key.size
     return result
 
-def get_local_uri(m, file_names, _):
+def get_local_uri(m, files, _):
     """
-    populates file_names list with urls that matched the regex match object
+    populates files list with (url, file size, modification time) tuples for files that matched the regex match object
     returns the total filesize of all the files matched
     """
     path = m.group(2)
     result = 0
-    for root, _, files in os.walk(path):
-        for file_name in files:
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
             absolute_path = os.path.join(root, file_name)
-            file_names.append("file:/{}".format(absolute_path))
-            result += os.path.getsize(absolute_path)
+            file_size = os.path.getsize(absolute_path)
+            files.append(("file:/{}".format(absolute_path), file_size, repr(os.path.getmtime(absolute_path))))
+            result += file_size
     return result
 
+def download_s3_range(config, bucket_name, path, file_name, start, end):
+    """ downloads bytes start through end (inclusive) of s3 file into the same position of local file_name """
+    for attempt in xrange(S3_RANGE_RETRIES):
+        try:
+            k = Key(get_s3_bucket(bucket_name, config))
+            k.key = path
+            data = k.get_contents_as_string(headers={"Range": "bytes={}-{}".format(start, end)})
+            if len(data) != end - start + 1:
+                raise IOError("got {} bytes instead of {}".format(len(data), end - start + 1))
+            with open(file_name, "r+b") as f:
+                f.seek(start)
+                f.write(data)
+            return
+        except Exception:
+            if attempt == S3_RANGE_RETRIES - 1:
+                raise
+            time.sleep(S3_RANGE_RETRY_DELAY * 2 ** attempt)
+
+def get_range_download_pool(concurrency):
+    """ returns thread pool of concurrency threads, their s3 connections are reused by every file downloaded in ranges """
+    with RANGE_DOWNLOAD_POOLS_LOCK:
+        if concurrency not in RANGE_DOWNLOAD_POOLS:
+            RANGE_DOWNLOAD_POOLS[concurrency] = ThreadPool(concurrency)
+        return RANGE_DOWNLOAD_POOLS[concurrency]
+
+def download_s3_ranges(config, bucket_name, path, file_name, file_size):
+    """ downloads s3 file in byte ranges using config.ranged_download_concurrency threads """
+    with open(file_name, "wb") as f:
+        f.truncate(file_size)
+    part_size = config.ranged_download_part_size
+    pool = get_range_download_pool(config.ranged_download_concurrency)
+    pool.map(lambda start: download_s3_range(config, bucket_name, path, file_name, start, min(start + part_size, file_size) - 1),
+             xrange(0, file_size, part_size))
+
 def download_s3_uri(m, config):
     bucket_name = m.group(1)
     path = m.group(2)
     bucket = get_s3_bucket(bucket_name, config)
-    k = Key(bucket)
-    k.key = path
     with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        k.get_contents_to_filename(temp_file.name)
-        return temp_file.name
+        try:
+            if config.ranged_download_concurrency > 1:
+                k = bucket.get_key(path)
+                if k is not None and k.size >= config.ranged_download_threshold:
+                    download_s3_ranges(config, bucket_name, path, temp_file.name, k.size)
+                    return temp_file.name
+            k = Key(bucket)
+            k.key = path
+            k.get_contents_to_filename(temp_file.name)
+            return temp_file.name
+        except:
+            cleanup_s3_uri(temp_file.name)
+            raise
 
 def download_local_uri(m, _):
     return m.group(2)
 
+def open_s3_uri(m, config, offset=0):
+    bucket_name = m.group(1)
+    path = m.group(2)
+    bucket = get_s3_bucket(bucket_name, config)
+    k = bucket.get_key(path)
+    if k is None:
+        raise IOError("s3://{}/{} does not exist".format(bucket_name, path))
+    if offset > 0:
+        k.open_read(headers={"Range": "bytes={}-".format(offset)})
+    return k, k.size
+
+def open_local_uri(m, _, offset=0):
+    path = m.group(2)
+    f = open(path, "rb")
+    f.seek(offset)
+    return f, os.path.getsize(path)
+
 def cleanup_s3_uri(temp_filename):
     try:
         os.unlink(temp_filename)
@@ -77,36 +145,338 @@ def cleanup_s3_uri(temp_filename):
         pass
 
 URI_REGEXES = [
-    (re.compile(r"^s3://([^/]+)/?(.*)", re.IGNORECASE), get_s3_uri, download_s3_uri, cleanup_s3_uri),
-    (re.compile(r"^(file:/)?(/.*)", re.IGNORECASE), get_local_uri, download_local_uri, None)
+    (re.compile(r"^s3://([^/]+)/?(.*)", re.IGNORECASE), get_s3_uri, download_s3_uri, cleanup_s3_uri, open_s3_uri),
+    (re.compile(r"^(file:/)?(/.*)", re.IGNORECASE), get_local_uri, download_local_uri, None, open_local_uri)
 ]
 
-def get_uris(config):
-    """ returns a tuple of total file size in bytes, and the list of files """
-    file_names = []
+class InputStream(object):
+    """
+    read-only file-like object on top of raw_file that supports read(size) and close(),
+    used to pass input to MAP_FUNC without downloading it first when STREAM_INPUT is set in config
+    gzip compressed input is decompressed on the fly
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, raw_file, gzipped=False):
+        self.raw_file = raw_file
+        self.gzipped = gzipped
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self.buffer = b""
+        self.position = 0 # position in buffer where the next read starts
+        self.eof = False
+
+    def decompress(self, data):
+        result = self.decompressor.decompress(data)
+        # gzip files can consist of multiple members, every one of them needs a new decompressor
+        while self.decompressor.unused_data.lstrip(b"\x00"):
+            unused_data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            result += self.decompressor.decompress(unused_data)
+        return result
+
+    def fill_buffer(self):
+        """ reads more data into buffer, returns False if there's nothing left to read """
+        while not self.eof:
+            data = self.raw_file.read(self.CHUNK_SIZE)
+            if not data:
+                self.eof = True
+                break
+            if self.gzipped:
+                data = self.decompress(data)
+            if data:
+                # drop the part of buffer that was already read
+                self.buffer = self.buffer[self.position:] + data
+                self.position = 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) - self.position < size) and self.fill_buffer():
+            pass
+        end = len(self.buffer) if size < 0 else self.position + size
+        result = self.buffer[self.position:end]
+        self.position += len(result)
+        return result
+
+    def readline(self, size=-1):
+        start = self.position
+        while True:
+            end = self.buffer.find(b"\n", start) + 1
+            if end > 0:
+                return self.read(end - self.position if size < 0 else min(end - self.position, size))
+            if 0 <= size <= len(self.buffer) - self.position:
+                return self.read(size)
+            start = len(self.buffer) - self.position # position is reset to 0 when buffer is filled
+            if not self.fill_buffer():
+                return self.read(size)
+            start += self.position
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def close(self):
+        self.raw_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+class SplitFile(object):
+    """
+    read-only file-like object on top of raw_file that returns only the lines that start between start and end,
+    where the first line starts right after the first linebreak at or after start - 1,
+    and the last line ends with the first linebreak at or after end - 1
+    raw_file has to be positioned at start - 1, or at 0 for the first split of a file
+    """
+    def __init__(self, raw_file, start, end):
+        self.lines = InputStream(raw_file)
+        self.end = end
+        self.position = start # position of the next byte that will be read in the whole file
+        if start > 0:
+            # skip the line that belongs to the previous split, just the linebreak if that line ended at start - 1
+            self.position += len(self.lines.readline()) - 1
+        self.done = self.position >= end
+
+    def read(self, size=InputStream.CHUNK_SIZE):
+        if self.done:
+            return b""
+        data = self.lines.read(size)
+        if not data:
+            self.done = True
+        elif self.position + len(data) >= self.end:
+            # last line of this split is the one that contains byte at end - 1
+            linebreak = data.find(b"\n", max(self.end - 1 - self.position, 0))
+            if linebreak >= 0:
+                data = data[:linebreak + 1]
+                self.done = True
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.lines.close()
+
+SPLIT_REGEX = re.compile(r"^(.*)\t(\d+)\t(\d+)$")
+UNSPLITTABLE_EXTENSIONS = (".gz", ".bz2", ".zip", ".xz", ".lz4", ".snappy")
+
+def parse_split(uri):
+    """ returns a (uri, start, end) tuple for a split returned by get_uris, or (uri, None, None) for a whole file """
+    m = SPLIT_REGEX.match(uri)
+    if m is None:
+        return uri, None, None
+    return m.group(1), int(m.group(2)), int(m.group(3))
+
+def get_splits(config, uri, file_size):
+    """
+    returns list of (split, size) tuples for splits of uri that are config.split_size bytes each,
+    or [(uri, file_size)] if it can't be split
+    """
+    if config.split_size <= 0 or file_size <= config.split_size or uri.lower().endswith(UNSPLITTABLE_EXTENSIONS):
+        return [(uri, file_size)]
+    splits = []
+    for start in xrange(0, file_size, config.split_size):
+        end = min(start + config.split_size, file_size)
+        splits.append(("{}\t{}\t{}".format(uri, start, end), end - start))
+    return splits
+
+def parse_batch(uri):
+    """ returns list of uris in a batch returned by get_uris, or just [uri] if it's not a batch """
+    if parse_split(uri)[1] is not None:
+        return [uri]
+    return uri.split("\t")
+
+def schedule_units(config, units):
+    """
+    returns list of (unit, size) tuples in the order they should be processed in according to config.schedule:
+    listing order, largest first, or alternating between the largest and smallest remaining ones
+    """
+    if config.schedule == "listing":
+        return units
+    units = sorted(units, key=lambda unit: unit[1], reverse=True)
+    if config.schedule == "largest-first":
+        return units
+    interleaved = []
+    for i in xrange(len(units) // 2):
+        interleaved.append(units[i])
+        interleaved.append(units[-i - 1])
+    if len(units) % 2 == 1:
+        interleaved.append(units[len(units) // 2])
+    return interleaved
+
+def expand_dates(config, uri):
+    """
+    returns list of (uri, day) tuples for every day of the job if uri uses {year}/{month}/{day} macros,
+    or just [(uri, None)]
+    """
+    if not (config.start_date or config.date_range) or not ("{year" in uri or "{month" in uri or "{day" in uri):
+        return [(uri, None)]
+    # +1 because we want to include end_date
+    num_days = config.date_range or ((config.end_date - config.start_date).days + 1)
+    return [(uri.format(year=tmp_date.year, month=tmp_date.month, day=tmp_date.day), tmp_date) \
+            for tmp_date in date_generator(config.end_date, num_days)]
+
+def list_uri(config, uri):
+    """ returns list of (uri, file size, etag or modification time) tuples for files that match uri """
+    files = []
+    for regex, uri_method, _, _, _ in URI_REGEXES:
+        m = regex.match(uri)
+        if m is not None:
+            uri_method(m, files, config)
+            break
+    return files
+
+def load_manifest(manifest_path):
+    """ returns dict of listed uri -> {"day", "listed_at", "files"} stored in manifest_path, or empty dict """
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)["uris"]
+
+def save_manifest(manifest_path, manifest):
+    temp_path = "{}.tmp".format(manifest_path)
+    with open(temp_path, "w") as f:
+        json.dump({"uris": manifest}, f)
+    os.rename(temp_path, manifest_path) # don't leave a partially written manifest behind
+
+def get_listing(config, manifest, uri, day):
+    """
+    returns manifest entry with files that match uri, reusing the one from manifest if there is one
+    and uri doesn't need to be listed again: listings of days that ended more than config.manifest_settle_days
+    before they were listed are reused, while more recent days could still be getting new files.
+    uris without a day are reused for config.manifest_max_age days after they were listed, if it's set
+    """
+    entry = manifest.get(uri)
+    if entry is not None:
+        # not using strptime, it isn't thread-safe in python 2
+        listed_at = datetime(*(int(x) for x in re.split("[-T:]", entry["listed_at"])))
+        if day is None:
+            if config.manifest_max_age is not None and datetime.utcnow() - listed_at < timedelta(config.manifest_max_age):
+                return entry
+        elif (listed_at.date() - day).days > config.manifest_settle_days:
+            return entry
+    return {
+        "day": day.isoformat() if day else None,
+        "listed_at": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": list_uri(config, uri)
+    }
+
+def list_files(config):
+    """
+    yields (uri, file size, etag or modification time) tuples for files in INPUT_DATA in listing order,
+    as soon as they are listed
+    every day of every INPUT_DATA entry is listed separately, by up to config.listing_concurrency threads at once
+    with config.manifest listings are reused from the manifest if possible and the manifest is updated at the end
+    """
     if config.INPUT_DATA is None:
         sys.stderr.write("you need to provide INPUT_DATA in config\n")
         sys.exit(1)
     if isinstance(config.INPUT_DATA, basestring):
         config.INPUT_DATA = [config.INPUT_DATA]
-    file_size = 0
-    for uri in config.INPUT_DATA:
-        for regex, uri_method, _, _ in URI_REGEXES:
-            m = regex.match(uri)
-            if m is not None:
-                file_size += uri_method(m, file_names, config)
-                break
-    print("going to process {} files...".format(len(file_names)))
-    return file_size, file_names
+    uris = [expanded_uri for uri in config.INPUT_DATA for expanded_uri in expand_dates(config, uri)]
+    manifest = load_manifest(config.manifest) if config.manifest else {}
+    pool = ThreadPool(max(min(config.listing_concurrency, len(uris)), 1))
+    try:
+        for (uri, _), entry in izip(uris, pool.imap(lambda x: get_listing(config, manifest, x[0], x[1]), uris)):
+            manifest[uri] = entry
+            for file_uri, file_size, file_version in entry["files"]:
+                yield file_uri, file_size, file_version
+    finally:
+        pool.terminate()
+        pool.join()
+    if config.manifest:
+        save_manifest(config.manifest, manifest)
+
+def list_units(config, files=None):
+    """
+    yields (unit, size) tuples for files, splits and batches to process in listing order, as soon as they are listed
+    a batch is a tab separated list of files smaller than config.batch_size, with a total size of up to
+    config.batch_size bytes, (uri, file size, etag or modification time) tuple of every listed file is appended
+    to files if it's passed in
+    """
+    batch = []
+    batch_size = 0
+    for uri, file_size, file_version in list_files(config):
+        if files is not None:
+            files.append((uri, file_size, file_version))
+        if file_size >= config.batch_size:
+            for split in get_splits(config, uri, file_size):
+                yield split
+            continue
+        if batch_size + file_size > config.batch_size and len(batch) > 0:
+            yield "\t".join(batch), batch_size
+            batch = []
+            batch_size = 0
+        batch.append(uri)
+        batch_size += file_size
+    if len(batch) > 0:
+        yield "\t".join(batch), batch_size
+
+def describe_units(files_count, units_count):
+    if units_count != files_count:
+        return "going to process {} files in {} splits and batches...".format(files_count, units_count)
+    return "going to process {} files...".format(units_count)
+
+def get_uris(config, file_sizes=None, files=None):
+    """
+    returns a tuple of total file size in bytes, and the list of files in the order they should be processed in,
+    and fills file_sizes dict with size of each of them if it's passed in
+    (uri, file size, etag or modification time) tuple of every listed file is appended to files if it's passed in
+    """
+    if files is None:
+        files = []
+    units = schedule_units(config, list(list_units(config, files)))
+    file_names = [unit for unit, _ in units]
+    if file_sizes is not None:
+        file_sizes.update(units)
+    print(describe_units(len(files), len(file_names)))
+    return sum(file_size for _, file_size, _ in files), file_names
+
+def open_raw_uri(config, uri, offset=0):
+    for regex, _, _, _, open_method in URI_REGEXES:
+        m = regex.match(uri)
+        if m is not None:
+            return open_method(m, config, offset)
+
+def open_split(config, uri, start, end):
+    """ returns SplitFile for reading lines of uri that belong to split between start and end """
+    raw_file, _ = open_raw_uri(config, uri, max(start - 1, 0))
+    return SplitFile(raw_file, start, end)
+
+def download_split(config, uri, start, end):
+    split_file = open_split(config, uri, start, end)
+    try:
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            try:
+                shutil.copyfileobj(split_file, temp_file)
+            except:
+                cleanup_s3_uri(temp_file.name)
+                raise
+            return temp_file.name
+    finally:
+        split_file.close()
 
 def download(config, uri):
-    for regex, _, dl_method, _ in URI_REGEXES:
+    uri, start, end = parse_split(uri)
+    if start is not None:
+        return download_split(config, uri, start, end)
+    for regex, _, dl_method, _, _ in URI_REGEXES:
         m = regex.match(uri)
         if m is not None:
             return dl_method(m, config)
 
 def cleanup(uri, temp_filename):
-    for regex, _, _, cleanup_method in URI_REGEXES:
+    if parse_split(uri)[1] is not None:
+        return cleanup_s3_uri(temp_filename) # splits are always downloaded into temp files
+    for regex, _, _, cleanup_method, _ in URI_REGEXES:
         m = regex.match(uri)
         if m is not None and cleanup_method is not None:
             return cleanup_method(temp_filename)
+
+def open_uri(config, uri):
+    """ returns a tuple of InputStream for reading uri without downloading it first, and its size in bytes """
+    uri, start, end = parse_split(uri)
+    if start is not None:
+        return InputStream(open_split(config, uri, start, end)), end - start
+    raw_file, file_size = open_raw_uri(config, uri)
+    return InputStream(raw_file, uri.lower().endswith(".gz")), file_size
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+smr-worker daemon, used with --engine daemon
+
+stays up on a host and runs smr-map and smr-reduce workers of back-to-back jobs without starting new processes
+for them. every smr that connects to its unix socket gets a template of its own, forked from the daemon, which loads
+the job's config once and forks the job's workers the same way the template of --engine fork does.
+only processes of the user running the daemon can connect to its socket
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import os
+import signal
+import socket
+import struct
+import sys
+
+from .config import DefaultConfig, get_instance_iam_profile
+from .forkserver import serve
+from .version import __version__
+
+ACCEPT_TIMEOUT = 1.0 # how often the daemon checks for templates that exited, in seconds
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17) # python 2 doesn't export it, this is its value on linux
+
+def reap_templates(templates):
+    while templates:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            break
+        templates.discard(pid)
+
+def get_peer_uid(connection):
+    """ returns uid of the process that connected to the socket, or None if it can't be found out on this platform """
+    if not sys.platform.startswith("linux"):
+        return None
+    _, uid, _ = struct.unpack(b"3i", connection.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize(b"3i")))
+    return uid
+
+def run(socket_path):
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, 0o700)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path) # left over from a daemon that didn't exit cleanly
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177) # socket is created with mode 0600
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(umask)
+    listener.listen(16)
+    listener.settimeout(ACCEPT_TIMEOUT)
+    # look it up once instead of in every job that doesn't have aws credentials
+    get_instance_iam_profile()
+    print("smr-worker v{} listening on {}".format(__version__, socket_path))
+    sys.stdout.flush()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    templates = set()
+    try:
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except socket.timeout:
+                connection = None
+            reap_templates(templates)
+            if connection is None:
+                continue
+            uid = get_peer_uid(connection)
+            if uid is not None and uid != os.getuid():
+                sys.stderr.write("rejected connection from uid {}\n".format(uid))
+                connection.close()
+                continue
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                listener.close()
+                connection.setblocking(1)
+                serve(connection.fileno(), connection.fileno(), load_config=True)
+            connection.close()
+            templates.add(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.unlink(socket_path)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", help="unix socket to listen on", default=DefaultConfig().worker_socket)
+    args = parser.parse_args()
+    run(args.socket)
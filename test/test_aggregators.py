@@ -0,0 +1,45 @@
+from smr import aggregators
+
+import sure
+
+def test_counter():
+    counter = aggregators.Counter()
+    counter.update(["a", "b", "a"])
+    other = aggregators.loads(aggregators.dumps(counter))
+    other.add("c", 5)
+    counter.merge(other)
+    counter.result().should.equal({"a": 4, "b": 2, "c": 5})
+    counter.most_common(2).should.equal([("c", 5), ("a", 4)])
+
+def test_sum_min_max():
+    aggregators.merge([aggregators.Sum(2), aggregators.Sum(3)]).result().should.equal(5)
+    aggregators.merge([aggregators.Min(), aggregators.Min(3), aggregators.Min(1)]).result().should.equal(1)
+    maximum = aggregators.loads(aggregators.dumps(aggregators.Max(5)))
+    aggregators.merge([aggregators.Max(2), maximum]).result().should.equal(5)
+    aggregators.merge([]).should.be.none
+
+def test_top_k():
+    top_k = aggregators.TopK(2, capacity=4)
+    for i in xrange(100):
+        top_k.add("frequent")
+        top_k.add("second", 2)
+        top_k.add("rare{}".format(i))
+    other = aggregators.loads(aggregators.dumps(top_k))
+    top_k.merge(other)
+    [key for key, _ in top_k.result()].should.equal(["second", "frequent"])
+    len(top_k.counts).should.be.lower_than(5)
+    for key, count in top_k.result():
+        # counts are underestimated by at most error
+        (count + top_k.error).should.be.greater_than_or_equal_to({"frequent": 200, "second": 400}[key])
+
+def test_hyperloglog():
+    hll = aggregators.HyperLogLog()
+    hll.update("value{}".format(i) for i in xrange(10000))
+    other = aggregators.HyperLogLog()
+    other.update("value{}".format(i) for i in xrange(5000, 20000))
+    hll.merge(aggregators.loads(aggregators.dumps(other)))
+    hll.result().should.be.within(19000, 21000)
+
+    small = aggregators.HyperLogLog()
+    small.update(["a", "b", "a"])
+    small.result().should.equal(2)
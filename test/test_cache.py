@@ -0,0 +1,78 @@
+from smr import get_default_config
+from smr.cache import MapCache
+from smr.map import read_units
+from smr.shared import format_unit
+
+import os
+import shutil
+import sure
+import tempfile
+
+def MAP_FUNC(file_name):
+    pass
+
+def test_map_cache():
+    config = get_default_config()
+    config.MAP_FUNC = MAP_FUNC
+    config.COMBINE_FUNC = None
+    config.map_cache = tempfile.mkdtemp()
+    try:
+        # files are never looked up, entries are keyed on the etag or modification time that smr sent
+        uris = ["s3://test-bucket/file{}".format(i) for i in xrange(3)]
+        cache = MapCache(config)
+        entry = cache.get(uris[0], "1")
+        entry.output.should.be.none
+        writer = cache.writer(entry)
+        writer.emit("first")
+        writer.emit("second\nrecord")
+        writer.commit()
+
+        entry = cache.get(uris[0], "1")
+        list(entry.read_records()).should.equal(["first", "second\nrecord"])
+        cache.get(uris[0], "2").output.should.be.none # file changed since it was cached
+        cache.get("{}\t0\t50".format(uris[0]), "1").output.should.be.none # splits are cached separately
+
+        # discarded entries are not cached
+        entry = cache.get(uris[1], "1")
+        writer = cache.writer(entry)
+        writer.emit("first")
+        writer.discard()
+        cache.get(uris[1], "1").output.should.be.none
+
+        # least recently used entries are evicted once the cache doesn't fit into map_cache_size
+        entry_size = os.path.getsize(cache.get(uris[0], "1").path)
+        writer = cache.writer(cache.get(uris[1], "1"))
+        writer.emit("first")
+        writer.emit("second\nrecord")
+        writer.commit()
+        cache.get(uris[0], "1") # first entry is used after the second one
+        config.map_cache_size = entry_size * 5 // 2 # two entries fit
+        writer = cache.writer(cache.get(uris[2], "1"))
+        writer.emit("first")
+        writer.emit("second\nrecord")
+        writer.commit()
+        cache.get(uris[1], "1").output.should.be.none
+        cache.get(uris[0], "1").output.should_not.be.none
+        cache.get(uris[2], "1").output.should_not.be.none
+    finally:
+        shutil.rmtree(config.map_cache)
+
+def test_file_stats():
+    config = get_default_config()
+    file_stats = {"s3://test-bucket/file0": (100, "etag0"), "s3://test-bucket/file1": (10, "etag1")}
+    units = ["s3://test-bucket/file0\t0\t50", "s3://test-bucket/file0\t50\t100", "s3://test-bucket/file0\ts3://test-bucket/file1"]
+
+    # units are sent as they are without --map-cache
+    [format_unit(config, unit, file_stats) for unit in units].should.equal(units)
+    list(read_units(units, None)).should.equal(units)
+
+    # with --map-cache smr-map gets size and etag or modification time of every file or split in a unit
+    config.map_cache = "unused"
+    smr_map_stats = {}
+    list(read_units([format_unit(config, unit, file_stats) for unit in units], smr_map_stats)).should.equal(units)
+    smr_map_stats.should.equal({
+        "s3://test-bucket/file0\t0\t50": (50, "etag0"),
+        "s3://test-bucket/file0\t50\t100": (50, "etag0"),
+        "s3://test-bucket/file0": (100, "etag0"),
+        "s3://test-bucket/file1": (10, "etag1")
+    })
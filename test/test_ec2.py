@@ -0,0 +1,64 @@
+from smr.config import get_config, configure_job
+from smr.uri import get_uris
+import smr.ec2
+
+import cPickle as pickle
+import json
+import os
+import shutil
+import sure
+import tempfile
+
+INCREMENTAL_CONFIG = """
+INPUT_DATA = "{}"
+TOTAL = [0]
+def MAP_FUNC(file_name):
+    for line in open(file_name):
+        print(line.strip())
+def REDUCE_FUNC(line):
+    TOTAL[0] += int(line)
+def SNAPSHOT_FUNC():
+    return TOTAL[0]
+def RESTORE_FUNC(state):
+    TOTAL[0] += state
+def OUTPUT_RESULTS_FUNC():
+    print(TOTAL[0])
+"""
+
+def test_incremental_run_without_new_files():
+    temp_dir = tempfile.mkdtemp()
+    connect_to_region = smr.ec2.boto.ec2.connect_to_region
+    try:
+        input_dir = os.path.join(temp_dir, "input")
+        os.mkdir(input_dir)
+        with open(os.path.join(input_dir, "file1"), "w") as f:
+            f.write("1\n2\n")
+        config_path = os.path.join(temp_dir, "incremental_job.py")
+        with open(config_path, "w") as f:
+            f.write(INCREMENTAL_CONFIG.format(input_dir))
+        state_path = os.path.join(temp_dir, "state")
+        output_path = os.path.join(temp_dir, "output")
+        config = get_config([config_path, "--incremental", state_path, "--output-filename", output_path, "--engine", "fork",
+                             "--aws-access-key", "test_access_key", "--aws-secret-key", "test_secret_key", "--no-output-job-progress"])
+
+        # previous run processed every file there is
+        configure_job(config)
+        listed_files = []
+        get_uris(config, {}, listed_files)
+        snapshot_path = "{}.1.snapshot0".format(state_path)
+        with open(snapshot_path, "wb") as f:
+            pickle.dump(3, f, pickle.HIGHEST_PROTOCOL)
+        with open(state_path, "w") as f:
+            json.dump({"run": 1, "files": dict((uri, version) for uri, _, version in listed_files), "snapshots": [snapshot_path]}, f)
+
+        started_instances = []
+        smr.ec2.boto.ec2.connect_to_region = lambda *args, **kwargs: started_instances.append(args)
+        smr.ec2.run(config)
+        started_instances.should.be.empty
+        with open(output_path) as f:
+            f.read().should.equal("3\n")
+        with open(state_path) as f:
+            json.load(f)["run"].should.equal(2)
+    finally:
+        smr.ec2.boto.ec2.connect_to_region = connect_to_region
+        shutil.rmtree(temp_dir)
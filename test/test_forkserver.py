@@ -0,0 +1,90 @@
+from smr.forkserver import ForkServer
+from smr.worker import run as run_worker_daemon
+
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import sure
+import tempfile
+import time
+
+REDUCE_CONFIG = """
+INPUT_DATA = "file://unused"
+TOTAL = [0]
+def REDUCE_FUNC(line):
+    TOTAL[0] += int(line)
+def OUTPUT_RESULTS_FUNC():
+    print(TOTAL[0])
+"""
+
+# adds 1 to every number if SMR_TEST_VARIABLE is set in the environment of the worker
+ENVIRONMENT_CONFIG = REDUCE_CONFIG.replace("int(line)", "int(line) + len(__import__('os').environ.get('SMR_TEST_VARIABLE', ''))")
+
+def get_reduce_args(temp_dir, config=REDUCE_CONFIG, name="forkserver_job"):
+    config_path = os.path.join(temp_dir, "{}.py".format(name))
+    with open(config_path, "w") as f:
+        f.write(config)
+    return ["smr-reduce", config_path, "--aws-access-key", "test_access_key", "--aws-secret-key", "test_secret_key"]
+
+def reduce_numbers(fork_server, args, output_path):
+    """ returns output of smr-reduce forked by fork_server that got numbers 1 through 100 """
+    process = fork_server.spawn(args, subprocess.PIPE, output_path, subprocess.PIPE)
+    process.stdin.write("".join("{}\n".format(i) for i in xrange(1, 101)))
+    _, stderr = process.communicate()
+    stderr.should.equal("")
+    process.returncode.should.equal(0)
+    with open(output_path) as f:
+        return f.read()
+
+def test_spawn():
+    temp_dir = tempfile.mkdtemp()
+    fork_server = ForkServer()
+    try:
+        reduce_numbers(fork_server, get_reduce_args(temp_dir), os.path.join(temp_dir, "output")).should.equal("5050\n")
+    finally:
+        fork_server.close()
+        shutil.rmtree(temp_dir)
+
+def test_spawn_after_template_exited():
+    temp_dir = tempfile.mkdtemp()
+    fork_server = ForkServer()
+    try:
+        fork_server.requests.write("not a request\n") # template exits once it can't parse it
+        fork_server.spawn.when.called_with(get_reduce_args(temp_dir), subprocess.PIPE, None, subprocess.PIPE).should.throw(IOError)
+    finally:
+        fork_server.close()
+        shutil.rmtree(temp_dir)
+
+def test_daemon():
+    temp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(temp_dir, "sockets", "worker.sock")
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker_daemon(socket_path)
+        finally:
+            os._exit(0)
+    os.environ["SMR_TEST_VARIABLE"] = "1"
+    try:
+        for _ in xrange(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+        stat.S_IMODE(os.stat(socket_path).st_mode).should.equal(0o600)
+        stat.S_IMODE(os.stat(os.path.dirname(socket_path)).st_mode).should.equal(0o700)
+
+        # environment of smr is only sent if it's asked for
+        for name, env_names, output in (("daemon_job", [], "5050\n"), ("daemon_env_job", ["SMR_TEST_VARIABLE"], "5150\n")):
+            fork_server = ForkServer(socket_path, env_names)
+            try:
+                args = get_reduce_args(temp_dir, ENVIRONMENT_CONFIG, name)
+                reduce_numbers(fork_server, args, os.path.join(temp_dir, name)).should.equal(output)
+            finally:
+                fork_server.close()
+    finally:
+        del os.environ["SMR_TEST_VARIABLE"]
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,84 @@
+from smr import reduce as smr_reduce
+from smr.reduce import read_line_batches, group_records, split_records
+from smr.transport import encode_control, encode_frame, parse_control
+
+from argparse import Namespace
+import base64
+import cPickle as pickle
+import os
+import shutil
+import sure
+import sys
+import tempfile
+
+def get_batches(data, controlled):
+    with tempfile.TemporaryFile() as f:
+        f.write(data)
+        f.seek(0)
+        return list(read_line_batches(f, controlled))
+
+def test_read_line_batches():
+    get_batches(b"a\nb\n\nc", False).should.equal([["a", "b", ""], ["c"]])
+    get_batches(b"", False).should.equal([])
+    get_batches(b"a \r\nb\t\nc\r", False).should.equal([["a", "b"], ["c"]]) # same as records without batches
+
+    control = encode_control("lines", "checkpoint", "/tmp/journal.1.snapshot0")
+    data = b"a\nb\n" + control + b"c\n"
+    get_batches(data, True).should.equal([["a", "b"], [control.rstrip(b"\n")], ["c"]])
+    get_batches(data, False).should.equal([["a", "b", control.rstrip(b"\n"), "c"]])
+
+def test_read_line_batches_in_chunks():
+    read_size = smr_reduce.BATCH_READ_SIZE
+    smr_reduce.BATCH_READ_SIZE = 4
+    try:
+        batches = get_batches(b"first\nsecond\nthird\n", False)
+    finally:
+        smr_reduce.BATCH_READ_SIZE = read_size
+    [line for batch in batches for line in batch].should.equal(["first", "second", "third"])
+
+def test_group_records():
+    records = ["a\t1", "a\t2", "a b\t3", "b", "b\t4"]
+    groups = [(key, list(values)) for key, values in group_records(records)]
+    groups.should.equal([("a", ["1", "2"]), ("a b", ["3"]), ("b", ["", "4"])])
+
+def test_split_records():
+    config = Namespace(transport="lines")
+    split_records(config, b"a\nb\nc").should.equal((["a", "b"], "c"))
+    split_records(config, b"a\n").should.equal((["a"], ""))
+    split_records(config, b"a \r\nb\r").should.equal((["a"], "b\r"))
+
+    config = Namespace(transport="framed")
+    frame = encode_frame(["c"])
+    split_records(config, encode_frame(["a", "b"]) + frame[:-1]).should.equal((["a", "b"], frame[:-1]))
+    split_records(config, frame[:2]).should.equal(([], frame[:2]))
+
+def test_run_local():
+    temp_dir = tempfile.mkdtemp()
+    local_input = os.path.join(temp_dir, "local_input")
+    os.mkfifo(local_input)
+    # mappers wrote into the FIFO and exited, then smr-ec2 closed stdin
+    input_fd = os.open(local_input, os.O_RDWR)
+    os.write(input_fd, b"1\r\n2\n3 \n")
+    stdin_read, stdin_write = os.pipe()
+    os.close(stdin_write)
+
+    records = []
+    config = Namespace(local_input=local_input, compress_output=0, local_reduce_interval=60, transport="lines",
+                       REDUCE_BATCH_FUNC=None, REDUCE_FUNC=records.append, RESET_FUNC=None, SNAPSHOT_FUNC=lambda: list(records))
+    stdin, stdout = sys.stdin, sys.stdout
+    try:
+        with os.fdopen(stdin_read, "rb") as smr_stdin, tempfile.TemporaryFile() as output:
+            sys.stdin, sys.stdout = smr_stdin, output
+            smr_reduce.run_local(config)
+            output.seek(0)
+            partials = output.read().splitlines()
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout # run_local replaces stdout with stderr
+        os.close(input_fd)
+        shutil.rmtree(temp_dir)
+
+    records.should.equal(["1", "2", "3"])
+    len(partials).should.equal(1) # everything is sent at once without RESET_FUNC
+    command, argument = parse_control(partials[0])
+    command.should.equal("merge")
+    pickle.loads(base64.b64decode(argument)).should.equal(["1", "2", "3"])
@@ -0,0 +1,57 @@
+from smr import get_default_config
+from smr.shared import get_partition, merge_sorted, skip_processed, IncrementalState, process_file_status, get_completed_files
+
+import json
+import os
+from Queue import Queue
+import sure
+import tempfile
+
+def test_get_partition():
+    config = get_default_config()
+    config.PARTITION_FUNC = lambda line: line.split("\t", 1)[0]
+    get_partition(config, "word\t1\n").should.equal(0)
+
+    config.reducers = 4
+    partition = get_partition(config, "word\t1\n")
+    range(4).should.contain(partition)
+    get_partition(config, "word\t2\n").should.equal(partition)
+
+def test_merge_sorted():
+    partitions = [["a,1\n", "c,3\n"], [], ["b,2\n", "d,4\n", "e,5\n"]]
+    lines = list(merge_sorted(partitions))
+    lines.should.equal(["a,1\n", "b,2\n", "c,3\n", "d,4\n", "e,5\n"])
+
+    partitions = [["c,3\n", "a,1\n"], ["d,4\n", "b,2\n"]]
+    lines = list(merge_sorted(partitions, key=lambda line: -int(line.rsplit(",", 1)[1])))
+    lines.should.equal(["d,4\n", "c,3\n", "b,2\n", "a,1\n"])
+
+def test_skip_processed():
+    units = [("s3://bucket/a\ts3://bucket/b", 20), ("s3://bucket/c\t0\t100", 100), ("s3://bucket/d", 50)]
+    list(skip_processed(units, {"s3://bucket/a", "s3://bucket/c"})).should.equal([("s3://bucket/b", 10), ("s3://bucket/d", 50)])
+    list(skip_processed(units, {"s3://bucket/c\t0\t100"})).should.equal([units[0], units[2]])
+
+def test_incremental_state():
+    config = get_default_config()
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        json.dump({"run": 1, "files": {"s3://bucket/a": "etag1", "s3://bucket/b": "etag2"}, "snapshots": ["snapshot0"]}, f)
+    config.incremental = f.name
+
+    try:
+        state = IncrementalState(config)
+        files = [("s3://bucket/a", 10, "etag1"), ("s3://bucket/b", 10, "etag2"), ("s3://bucket/c", 10, "etag3")]
+        state.get_unchanged(files).should.equal({"s3://bucket/a", "s3://bucket/b"})
+        state.snapshots.should.equal(["snapshot0"])
+
+        # every file is processed again if any of them changed
+        state = IncrementalState(config)
+        state.get_unchanged([("s3://bucket/a", 10, "etag4"), ("s3://bucket/b", 10, "etag2")]).should.be.empty
+        state.snapshots.should.be.empty
+    finally:
+        os.unlink(f.name)
+
+def test_completed_files():
+    files = [("s3://bucket/a", 10, "etag1"), ("s3://bucket/b", 200, "etag2"), ("s3://bucket/c", 10, "etag3")]
+    process_file_status("+", "100", "s3://bucket/b\t0\t100", Queue(), Queue())
+    process_file_status("!", "10", "s3://bucket/c", Queue(), Queue())
+    get_completed_files(files, {"s3://bucket/a"}).should.equal(files[:2])
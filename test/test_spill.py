@@ -0,0 +1,36 @@
+from smr.spill import SpillingDict, sort_records
+
+import operator
+import sure
+
+def test_spilling_dict():
+    counts = SpillingDict(operator.add, memory_limit=1000)
+    expected = {}
+    for i in xrange(1000):
+        key = "key{}".format(i % 97)
+        counts.add(key, i)
+        expected[key] = expected.get(key, 0) + i
+    len(counts.runs).should.be.greater_than(1)
+    list(counts.iteritems()).should.equal(sorted(expected.iteritems()))
+    # runs can be merged again
+    list(counts).should.equal(sorted(expected))
+    counts.close()
+
+def test_spilling_dict_growing_value():
+    strings = SpillingDict(operator.add, memory_limit=1000)
+    for _ in xrange(20):
+        strings.add("key", "x" * 100)
+    len(strings.runs).should.be.greater_than(0) # merged values are measured again
+    list(strings.iteritems()).should.equal([("key", "x" * 2000)])
+    strings.close()
+
+def test_spilling_dict_in_memory():
+    counts = SpillingDict(operator.add)
+    counts.update([("b", 1), ("a", 2), ("b", 3)])
+    counts.runs.should.be.empty
+    list(counts.iteritems()).should.equal([("a", 2), ("b", 4)])
+
+def test_sort_records():
+    records = ["key{}\t{}".format(i % 13, i) for i in xrange(500)]
+    list(sort_records(iter(records), memory_limit=1000)).should.equal(sorted(records))
+    list(sort_records([])).should.equal([])
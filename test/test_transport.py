@@ -0,0 +1,78 @@
+from smr.transport import encode_frame, decode_frame, read_frame, read_records, write_attempt, read_attempt, \
+    encode_control, parse_control, CompressedWriter, DecompressedReader
+
+import sure
+from StringIO import StringIO
+
+def test_frames():
+    records = ["first", "second\nrecord with a linebreak", ""]
+    frame = encode_frame(records)
+    decode_frame(frame).should.equal(records)
+
+    stream = StringIO(frame + encode_frame(["third"]))
+    read_frame(stream).should.equal(frame)
+    decode_frame(read_frame(stream)).should.equal(["third"])
+    read_frame(stream).should.be.none
+
+def test_read_records():
+    stream = StringIO(encode_frame(["a", "b"]) + encode_frame(["c"]))
+    list(read_records(stream)).should.equal(["a", "b", "c"])
+
+    # truncated frame is ignored
+    frame = encode_frame(["d"])
+    stream = StringIO(encode_frame(["a"]) + frame[:-1])
+    list(read_records(stream)).should.equal(["a"])
+
+def test_attempts():
+    stream = StringIO()
+    output = StringIO()
+    output.write("line 1\nline 2\n")
+    write_attempt(stream, "s3://bucket/file1", output)
+    write_attempt(stream, "s3://bucket/file2", StringIO())
+
+    data = stream.getvalue()
+    stream = StringIO(data)
+    output = StringIO()
+    read_attempt(stream, output).should.equal("s3://bucket/file1")
+    output.getvalue().should.equal("line 1\nline 2\n")
+    output = StringIO()
+    read_attempt(stream, output).should.equal("s3://bucket/file2")
+    output.getvalue().should.equal("")
+    read_attempt(stream, output).should.be.none
+
+    # truncated attempt is ignored
+    read_attempt(StringIO(data[:-20]), StringIO()).should.equal("s3://bucket/file1")
+    read_attempt(StringIO(data[:20]), StringIO()).should.be.none
+
+def test_control():
+    record = encode_control("lines", "checkpoint", "/tmp/journal.1.snapshot0")
+    record.endswith("\n").should.be.true
+    parse_control(record.rstrip("\n")).should.equal(("checkpoint", "/tmp/journal.1.snapshot0"))
+    parse_control(b"checkpoint /tmp/journal").should.be.none
+
+    frame = encode_control("framed", "restore", "/tmp/journal.1.snapshot0")
+    records = decode_frame(frame)
+    records.should.have.length_of(1)
+    parse_control(records[0]).should.equal(("restore", "/tmp/journal.1.snapshot0"))
+
+def test_compression():
+    stream = StringIO()
+    writer = CompressedWriter(stream, 6)
+    writer.write("line 1\nline 2\n")
+    writer.flush()
+    flushed = stream.getvalue()
+    writer.write(encode_frame(["a", "b"]))
+    writer.close()
+
+    # everything written before flush() can be decompressed before the rest of the stream arrives
+    reader = DecompressedReader(StringIO(flushed).read)
+    reader.readline().should.equal("line 1\n")
+    reader.readline().should.equal("line 2\n")
+
+    reader = DecompressedReader(StringIO(stream.getvalue()).read)
+    reader.readline().should.equal("line 1\n")
+    reader.readline().should.equal("line 2\n")
+    decode_frame(read_frame(reader)).should.equal(["a", "b"])
+    reader.read(1).should.equal("")
+    reader.compressed_size.should.equal(len(stream.getvalue()))
+    reader.size.should.equal(len("line 1\nline 2\n" + encode_frame(["a", "b"])))
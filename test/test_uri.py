@@ -1,10 +1,17 @@
 from smr import get_default_config
-from smr.uri import get_uris
+import smr.uri
+from smr.uri import get_uris, open_uri, download, cleanup, parse_batch, expand_dates
 
 import sure
 from moto import mock_s3
 import boto
+from boto.s3.bucket import Bucket
 from boto.s3.key import Key
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
 
 def upload_file(bucket, file):
     k = Key(bucket)
@@ -38,3 +45,210 @@ def test_get_uris():
     len(uris).should.equal(2)
     uris.should.have("s3://mybucket/dir1/file1.csv")
     uris.should.have("s3://mybucket/dir1/dir2/file2.csv")
+
+def test_expand_dates():
+    config = get_default_config()
+    config.end_date = datetime.date(2015, 3, 1)
+    config.date_range = 2
+    expand_dates(config, "s3://mybucket/{year}/{month:02d}/{day:02d}/").should.equal([
+        ("s3://mybucket/2015/02/28/", datetime.date(2015, 2, 28)),
+        ("s3://mybucket/2015/03/01/", datetime.date(2015, 3, 1))
+    ])
+    expand_dates(config, "s3://mybucket/dir1").should.equal([("s3://mybucket/dir1", None)])
+
+@mock_s3
+def test_manifest():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    today = datetime.datetime.utcnow().date()
+    old_day = today - datetime.timedelta(3)
+    upload_file(bucket, "{}/file1.csv".format(old_day))
+    upload_file(bucket, "{}/file2.csv".format(today))
+
+    manifest_dir = tempfile.mkdtemp()
+    manifest_path = os.path.join(manifest_dir, "manifest.json")
+    config = get_config_for_prefix("s3://mybucket/{year}-{month:02d}-{day:02d}/")
+    config.end_date = today
+    config.date_range = 4
+    config.manifest = manifest_path
+    try:
+        bytes_total, uris = get_uris(config)
+        len(uris).should.equal(2)
+        os.path.isfile(manifest_path).should.be.true
+
+        # days that are over are reused from the manifest, while today is listed again
+        upload_file(bucket, "{}/file3.csv".format(old_day))
+        upload_file(bucket, "{}/file4.csv".format(today))
+        bytes_total, uris = get_uris(config)
+        len(uris).should.equal(3)
+        uris.should_not.have("s3://mybucket/{}/file3.csv".format(old_day))
+        uris.should.have("s3://mybucket/{}/file4.csv".format(today))
+
+        # uris without a day are listed again, unless they're younger than manifest_max_age
+        config.INPUT_DATA = "s3://mybucket/{}/".format(old_day)
+        bytes_total, uris = get_uris(config)
+        len(uris).should.equal(2)
+        upload_file(bucket, "{}/file5.csv".format(old_day))
+        bytes_total, uris = get_uris(config)
+        len(uris).should.equal(3)
+
+        config.manifest_max_age = 1
+        listed_prefixes = []
+        bucket_list = Bucket.list
+        def list_prefix(self, prefix="", *args, **kwargs):
+            listed_prefixes.append(prefix)
+            return bucket_list(self, prefix, *args, **kwargs)
+        upload_file(bucket, "{}/file6.csv".format(old_day))
+        Bucket.list = list_prefix
+        try:
+            bytes_total, uris = get_uris(config)
+        finally:
+            Bucket.list = bucket_list
+        listed_prefixes.should.be.empty
+        len(uris).should.equal(3)
+    finally:
+        shutil.rmtree(manifest_dir)
+
+@mock_s3
+def test_batches():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    file_names = ["file{}.csv".format(i) for i in xrange(10)] # 9 bytes each
+    for file_name in file_names:
+        upload_file(bucket, file_name)
+    upload_file(bucket, "large_file_{}.csv".format("x" * 100))
+
+    config = get_config_for_prefix("s3://mybucket")
+    config.batch_size = 20
+    bytes_total, uris = get_uris(config)
+    len(uris).should.equal(6)
+    uris.should.have("s3://mybucket/large_file_{}.csv".format("x" * 100))
+    batched_uris = []
+    for uri in uris:
+        batch = parse_batch(uri)
+        if len(batch) > 1:
+            len(batch).should.equal(2)
+            batched_uris.extend(batch)
+    sorted(batched_uris).should.equal(["s3://mybucket/{}".format(file_name) for file_name in file_names])
+
+@mock_s3
+def test_schedule():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    for i in xrange(1, 6):
+        upload_file(bucket, "file{}.csv".format("x" * i))
+
+    config = get_config_for_prefix("s3://mybucket")
+    config.schedule = "largest-first"
+    file_sizes = {}
+    bytes_total, uris = get_uris(config, file_sizes)
+    [file_sizes[uri] for uri in uris].should.equal([13, 12, 11, 10, 9])
+    bytes_total.should.equal(sum(file_sizes.values()))
+
+    config.schedule = "interleaved"
+    bytes_total, uris = get_uris(config, file_sizes)
+    [file_sizes[uri] for uri in uris].should.equal([13, 9, 12, 10, 11])
+
+@mock_s3
+def test_ranged_download():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    contents = "".join(chr(i % 256) for i in xrange(10000))
+    k = Key(bucket)
+    k.key = "large_file"
+    k.set_contents_from_string(contents)
+
+    config = get_config_for_prefix("s3://mybucket")
+    config.ranged_download_concurrency = 4
+    config.ranged_download_threshold = 1000
+    config.ranged_download_part_size = 999
+    uri = "s3://mybucket/large_file"
+    temp_filename = download(config, uri)
+    try:
+        with open(temp_filename, "rb") as f:
+            f.read().should.equal(contents)
+    finally:
+        cleanup(uri, temp_filename)
+
+@mock_s3
+def test_ranged_download_retry():
+    conn = boto.connect_s3()
+    bucket = conn.create_bucket('mybucket')
+    contents = "".join(chr(i % 256) for i in xrange(10000))
+    k = Key(bucket)
+    k.key = "large_file"
+    k.set_contents_from_string(contents)
+
+    failed_ranges = []
+    class FlakyKey(Key):
+        def get_contents_as_string(self, headers=None, *args, **kwargs):
+            if headers["Range"].startswith("bytes=999-") and not failed_ranges:
+                failed_ranges.append(headers["Range"])
+                raise IOError("connection reset")
+            return Key.get_contents_as_string(self, headers, *args, **kwargs)
+
+    config = get_config_for_prefix("s3://mybucket")
+    config.ranged_download_concurrency = 4
+    config.ranged_download_threshold = 1000
+    config.ranged_download_part_size = 999
+    uri = "s3://mybucket/large_file"
+    retry_delay = smr.uri.S3_RANGE_RETRY_DELAY
+    smr.uri.Key = FlakyKey
+    smr.uri.S3_RANGE_RETRY_DELAY = 0
+    try:
+        temp_filename = download(config, uri)
+    finally:
+        smr.uri.Key = Key
+        smr.uri.S3_RANGE_RETRY_DELAY = retry_delay
+    try:
+        failed_ranges.should.equal(["bytes=999-1997"])
+        with open(temp_filename, "rb") as f:
+            f.read().should.equal(contents)
+    finally:
+        cleanup(uri, temp_filename)
+
+def test_splits():
+    temp_dir = tempfile.mkdtemp()
+    file_name = os.path.join(temp_dir, "file.txt")
+    lines = ["line {}\n".format(i) * (i % 7) for i in xrange(1000)]
+    with open(file_name, "w") as f:
+        f.writelines(lines)
+
+    config = get_config_for_prefix(temp_dir)
+    config.split_size = 1000
+    try:
+        bytes_total, uris = get_uris(config)
+        bytes_total.should.equal(os.path.getsize(file_name))
+        len(uris).should.equal((bytes_total + config.split_size - 1) // config.split_size)
+
+        contents = []
+        for uri in uris:
+            temp_filename = download(config, uri)
+            with open(temp_filename) as f:
+                contents.append(f.read())
+            cleanup(uri, temp_filename)
+            input_stream, _ = open_uri(config, uri)
+            with input_stream:
+                input_stream.read().should.equal(contents[-1])
+        "".join(contents).should.equal("".join(lines))
+    finally:
+        os.unlink(file_name)
+        os.rmdir(temp_dir)
+
+def test_open_uri():
+    lines = ["line {}\n".format(i) for i in xrange(10000)]
+    with tempfile.NamedTemporaryFile(suffix=".gz", delete=False) as temp_file:
+        # two gzip members, like common crawl files
+        for part in (lines[:5000], lines[5000:]):
+            with gzip.GzipFile(fileobj=temp_file, mode="wb") as f:
+                f.writelines(part)
+
+    try:
+        input_stream, file_size = open_uri(get_default_config(), temp_file.name)
+        file_size.should.equal(os.path.getsize(temp_file.name))
+        with input_stream:
+            input_stream.readline().should.equal(lines[0])
+            list(input_stream).should.equal(lines[1:])
+            input_stream.read().should.equal("")
+    finally:
+        os.unlink(temp_file.name)